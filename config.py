@@ -16,4 +16,19 @@ REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD", None)
 CELERY_REDIS_PASSWORD = REDIS_PASSWORD
 CELERY_BROKER_URL = "redis://:{REDIS_PASSWORD}@localhost:{REDIS_PORT}/0".format(REDIS_PASSWORD=REDIS_PASSWORD, REDIS_PORT=REDIS_PORT)
 CELERY_RESULT_BACKEND = CELERY_BROKER_URL
+SQL_SAMPLE_RATE = float(os.environ.get('REALESTATE_SQL_SAMPLE_RATE', 0.05))
+SQL_RECENT_REQUESTS = 200
 
+
+def _worker(queue, concurrency, prefetch):
+    prefix = 'REALESTATE_{}_'.format(queue.upper())
+    return {'concurrency': int(os.environ.get(prefix + 'CONCURRENCY', concurrency)),
+            'prefetch': int(os.environ.get(prefix + 'PREFETCH', prefetch))}
+
+# One worker per queue; see realestate/worker.py
+CELERY_WORKERS = {
+    'ingestion': _worker('ingestion', 2, 4),  # many small tasks
+    'scoring': _worker('scoring', 2, 1),
+    'cache': _worker('cache', 1, 1),  # few, long tasks
+    'notifications': _worker('notifications', 1, 8),
+}
@@ -0,0 +1,13 @@
+import os
+
+"""
+gunicorn settings, see wsgi.py. The workers are gevent workers,
+since /events/ keeps a connection open for every open page (see
+realestate/events.py); each worker serves up to worker_connections
+of them at a time.
+"""
+
+bind = os.environ.get('REALESTATE_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('REALESTATE_WEB_WORKERS', 2))
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('REALESTATE_WEB_CONNECTIONS', 1000))
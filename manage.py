@@ -1,13 +1,18 @@
+import sys
+import subprocess
 from manager import Manager
-from realestate import app
+from realestate import create_app
 from realestate.models import UserRealestateReview
 
+# Commands import what they need beyond the models themselves, so
+# that every other command doesn't pay for it.
+
 manager = Manager()
 
 
 @manager.command
 def run_test_server():
-    app.run(debug=True)
+    create_app().run(debug=True)
 
 
 @manager.arg(
@@ -28,5 +33,130 @@ def remove_user_reviews_for_property(property_id):
     print("Property reviews for property {} deleted!".format(property_id))
 
 
+@manager.command
+def migrate():
+    """
+    Bring an existing database up to date with the models.
+    """
+    from realestate import migrations
+    migrations.run()
+    print("Database migrated!")
+
+
+
+@manager.arg('sizes', help='Comma-separated numbers of properties')
+@manager.arg('repeat', help='Runs per benchmark')
+@manager.arg('output', help='Where to write the results (JSON)')
+@manager.command
+def benchmark(sizes='100,1000', repeat='5', output='benchmarks.json'):
+    """
+    Time the hot paths on synthetic data, see realestate/benchmarks.py
+    """
+    from realestate import benchmarks
+    results = benchmarks.run(sizes=[int(size) for size in sizes.split(',')],
+                             repeat=int(repeat))
+    benchmarks.write(results, output)
+    print("Benchmark results written to {}".format(output))
+
+
+
+@manager.arg('properties', help='Number of properties')
+@manager.arg('users', help='Number of users, named user0, user1, ...')
+@manager.arg('seed', help='Seed; the same seed gives the same data')
+@manager.command
+def synthetic_data(properties='500', users='4', seed='0'):
+    """
+    Fill the configured database with synthetic data, e.g. before
+    running loadtest against a local server.
+    """
+    from realestate import synthetic
+    from realestate.celery import prepare_caches
+    synthetic.generate(properties=int(properties), users=int(users), seed=int(seed))
+    prepare_caches()
+    print("Synthetic data generated! All users have password {}".format(synthetic.PASSWORD))
+
+
+@manager.arg('users', help='Number of simulated reviewers')
+@manager.arg('duration', help='Seconds to run')
+@manager.arg('url', help='Base url of a running server; the test client if empty')
+@manager.arg('properties', help='Number of synthetic properties (test client only)')
+@manager.command
+def run_loadtest(users='4', duration='30', url='', properties='500'):
+    """
+    Simulate reviewers working at the same time, see realestate/loadtest.py
+    """
+    from realestate import loadtest
+    report = loadtest.run(users=int(users), duration=float(duration),
+                          url=url or None, properties=int(properties))
+    print("{:<30} {:>8} {:>6} {:>8} {:>8} {:>8} {:>8}".format(
+        "route", "requests", "errors", "req/s", "p50", "p95", "p99"))
+    for route, stats in report.items():
+        print("{:<30} {requests:>8} {errors:>6} {throughput:>8} "
+              "{p50:>8} {p95:>8} {p99:>8}".format(route, **stats))
+
+
+
+@manager.arg('format', help='csv or jsonl')
+@manager.arg('output', help='File to write to; standard output if empty')
+@manager.arg('information', help='Comma-separated information fields to add, e.g. year,epc')
+@manager.command
+def export(format='csv', output='', information=''):
+    """
+    Export all properties with their scores and status
+    """
+    from realestate import export as bulk_export
+    information = [short for short in information.split(',') if short]
+    f = open(output, 'w', newline='') if output else sys.stdout
+    try:
+        for chunk in bulk_export.export(format, information):
+            f.write(chunk)
+    finally:
+        if output:
+            f.close()
+
+
+
+
+@manager.arg('queue', help='ingestion, scoring, cache or notifications')
+@manager.command
+def run_worker(queue):
+    """
+    A Celery worker for one queue, see realestate/worker.py
+    """
+    from realestate import worker
+    worker.start(queue)
+
+
+
+@manager.arg('retry', help='Only rerun the chunks that failed last time (y/n)')
+@manager.command
+def rescore(retry='n'):
+    """
+    Recompute all default scores on the scoring workers
+    """
+    from realestate.celery import rescore, retry_rescore
+    (retry_rescore if retry == 'y' else rescore).delay()
+    print("Rescore started! Follow its progress at /rescore/")
+
+
+ENTRY_POINTS = ['realestate.models', 'realestate.worker', 'manage', 'wsgi']
+
+
+@manager.arg('runs', help='Fresh interpreters per entry point')
+@manager.command
+def import_time(runs='5'):
+    """
+    How long importing each entry point takes, in a fresh interpreter
+    """
+    for module in ENTRY_POINTS:
+        durations = sorted(
+            float(subprocess.check_output([
+                sys.executable, '-c',
+                'import time; start = time.perf_counter(); import {}; '
+                'print(time.perf_counter() - start)'.format(module)]))
+            for _ in range(int(runs)))
+        print("{:<20} {:>8.0f}ms (best of {})".format(module, durations[0] * 1000, runs))
+
+
 if __name__ == '__main__':
     manager.main()
@@ -2,13 +2,14 @@ from flask import Flask
 from flask_wtf.csrf import CsrfProtect
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
-from flask_bootstrap import Bootstrap
-from flask_mail import Mail, Message
-from flask_googlemaps import GoogleMaps
-from flask_pagedown import PageDown
-from flaskext.markdown import Markdown
 from .utils import ListConverter
 
+"""
+The app object is created here, but the web side (views, filters,
+hooks and the template extensions) is only set up by create_app().
+Celery workers and manage.py commands that just need the models
+import this package without paying for it.
+"""
 
 app = Flask(__name__)
 app.config.from_object('config')
@@ -16,24 +17,40 @@ app.config.from_object('config')
 app.url_map.converters['list'] = ListConverter
 
 login_manager = LoginManager()
-login_manager.init_app(app)
 
-csrf = CsrfProtect(app)
-
-bcrypt = Bcrypt(app)
-
-Bootstrap(app)
-
-mail = Mail(app)
-
-GoogleMaps(app)
-
-pagedown = PageDown(app)
-
-Markdown(app)
-
-from .hooks import *
-from .controllers import *
-from .filters import *
-from .celery import *
-from .setup import *
+csrf = CsrfProtect()
+
+bcrypt = Bcrypt()  # works unbound, with the default number of rounds
+
+
+def create_app(**config):
+    """
+    Set up the web side of the app, with config overriding the
+    settings from config.py, and return it. There is one app per
+    process, since the views register on it when they're imported:
+    calling it again only applies config.
+    """
+    app.config.update(config)
+    if app.extensions.get('realestate'):
+        return app
+    from flask_bootstrap import Bootstrap
+    from flask_mail import Mail
+    from flask_googlemaps import GoogleMaps
+    from flask_pagedown import PageDown
+    from flaskext.markdown import Markdown
+
+    login_manager.init_app(app)
+    csrf.init_app(app)
+    bcrypt.init_app(app)
+    Bootstrap(app)
+    Mail(app)
+    GoogleMaps(app)
+    PageDown(app)
+    Markdown(app)
+
+    from . import hooks
+    from . import controllers
+    from . import filters
+    from . import setup
+    app.extensions['realestate'] = True
+    return app
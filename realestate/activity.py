@@ -0,0 +1,99 @@
+import json
+import time
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from realestate.models import r
+from realestate.models import ACTIVITY_KEY
+from realestate.models import FEED_LENGTH
+from realestate.models import User
+from realestate.models import feed_key
+
+"""
+Activity timeline: new listings, reviews, messages, appointments and
+properties sold.
+
+models.record() appends every entry to the activity log and to the
+feed of each user at write time, so a user's timeline is one range
+read of their feed. Both are sorted sets scored by time, standing in
+for Redis Streams, which neither our Redis client nor fakeredis
+support. Feeds are capped at FEED_LENGTH entries as they're written,
+and generate_feed(), which runs every hour, compacts entries older
+than max_age days into one summary per day. Users without a feed
+(new ones, or after Redis lost it) get the recent part of the log.
+"""
+
+PAGE_SIZE = 50
+
+
+def _entries(members):
+    return [json.loads(member.decode() if isinstance(member, bytes) else member)
+            for member in members]
+
+
+def timeline(user_id, before=None, limit=PAGE_SIZE):
+    """
+    The latest entries in a user's feed (before the timestamp before),
+    newest first
+    """
+    maximum = '({}'.format(before) if before is not None else '+inf'
+    return _entries(r.zrevrangebyscore(feed_key(user_id), maximum, '-inf',
+                                       start=0, num=limit))
+
+
+def _day_start(day):
+    return time.mktime(day.timetuple())
+
+
+def compact(key, cutoff):
+    """
+    Replace the entries of every day before cutoff (a date) by a
+    summary with the number of entries of each kind. Summaries of
+    the same day, from earlier runs, are merged.
+    """
+    end = _day_start(cutoff)
+    summaries = {}
+    entries = _entries(r.zrangebyscore(key, '-inf', '({}'.format(end)))
+    if all(entry['kind'] == 'summary' for entry in entries):
+        return
+    for entry in entries:
+        day = date.fromtimestamp(entry['ts']).isoformat()
+        counts = summaries.setdefault(day, {})
+        if entry['kind'] == 'summary':
+            for kind, count in entry['counts'].items():
+                counts[kind] = counts.get(kind, 0) + count
+        else:
+            counts[entry['kind']] = counts.get(entry['kind'], 0) + 1
+    pipe = r.pipeline()
+    pipe.zremrangebyscore(key, '-inf', '({}'.format(end))
+    for day, counts in summaries.items():
+        ts = _day_start(datetime.strptime(day, "%Y-%m-%d"))
+        pipe.zadd(key, json.dumps({'kind': 'summary', 'day': day, 'ts': ts, 'counts': counts},
+                                 sort_keys=True), ts)
+    pipe.execute()
+
+
+def backfill(user_id, since):
+    """
+    A feed for a user who doesn't have one: the latest entries
+    after the timestamp since from the activity log
+    """
+    members = r.zrevrangebyscore(ACTIVITY_KEY, '+inf', since, start=0, num=FEED_LENGTH)
+    pipe = r.pipeline()
+    for member, entry in zip(members, _entries(members)):
+        if entry.get('user') != user_id:
+            pipe.zadd(feed_key(user_id), member, entry['ts'])
+    pipe.execute()
+
+
+def generate_feed(max_age=2):
+    """
+    Compact everything older than max_age days, and give every
+    active user a feed
+    """
+    cutoff = date.today() - timedelta(days=max_age)
+    compact(ACTIVITY_KEY, cutoff)
+    for user_id, in User.select(User._id).where(User.active).tuples():
+        if not r.exists(feed_key(user_id)):
+            backfill(user_id, _day_start(cutoff))
+        compact(feed_key(user_id), cutoff)
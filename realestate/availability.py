@@ -0,0 +1,130 @@
+import heapq
+from datetime import datetime
+from datetime import timedelta
+from realestate.models import User
+from realestate.models import UserAvailability
+from realestate.models import Appointment
+from realestate.models import APPOINTMENT_DURATION
+
+"""
+When can everyone make it?
+
+Every user's availabilities are expanded into plain intervals within
+the search window (weekly ones once per week, so the work grows with
+the window, not with how long ago they were entered) and merged per
+user. A single sweep over the interval boundaries, in time order,
+then finds the stretches where all users are free and no appointment
+is planned: O(n log n) in the number of intervals, whatever the
+number of users.
+"""
+
+WEEK = timedelta(weeks=1)
+BUSY = 2
+
+
+def expand(availability, start, end):
+    """
+    The (start, end) intervals of an availability within [start, end)
+    """
+    length = (availability.end or availability.dt + APPOINTMENT_DURATION) - availability.dt
+    first = availability.dt
+    if availability.weekly:
+        if first + length <= start:  # skip straight to the first week that matters
+            first += WEEK * ((start - first - length) // WEEK + 1)
+        last = end
+        if availability.until is not None:
+            last = min(end, datetime.combine(availability.until, datetime.max.time()))
+    else:
+        last = first
+    while first <= last and first < end:
+        if first + length > start:
+            yield max(first, start), min(first + length, end)
+        if not availability.weekly:
+            return
+        first += WEEK
+
+
+def merge(intervals):
+    """
+    Sorted, non-overlapping union of intervals
+    """
+    merged = []
+    for interval_start, interval_end in sorted(intervals):
+        if merged and interval_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], interval_end)
+        else:
+            merged.append([interval_start, interval_end])
+    return [tuple(interval) for interval in merged]
+
+
+def _events(intervals, change):
+    for interval_start, interval_end in intervals:
+        yield interval_start, change
+        yield interval_end, -change
+
+
+def common(free, busy, duration):
+    """
+    Sweep line: the stretches of at least duration that are in every
+    list of free (one merged list per user) and in none of busy (also
+    merged). Lazily yielded in time order.
+    """
+    # An event is (time, change); a change of 1 is a user becoming free
+    # and BUSY an appointment starting. At equal times, ends (negative
+    # changes) come first, so touching intervals don't overlap.
+    events = heapq.merge(*[_events(intervals, 1) for intervals in free] +
+                         [_events(busy, BUSY)])
+    needed = len(free)
+    free_users = busy_count = 0
+    opened = None
+    for time, change in events:
+        if abs(change) == BUSY:
+            busy_count += change // BUSY
+        else:
+            free_users += change
+        if free_users == needed and busy_count == 0:
+            if opened is None:
+                opened = time
+        elif opened is not None:
+            if time - opened >= duration:
+                yield opened, time
+            opened = None
+
+
+def suggest(k=5, duration=APPOINTMENT_DURATION, start=None, days=28):
+    """
+    The earliest k stretches in the next days where all active users
+    are available for at least duration and nothing is planned
+    """
+    start = start or datetime.now()
+    end = start + timedelta(days=days)
+    users = [user_id for user_id, in User.select(User._id).where(User.active).tuples()]
+    if not users:
+        return []
+
+    intervals = {user_id: [] for user_id in users}
+    availabilities = (UserAvailability
+                      .select()
+                      .where((UserAvailability.user << users) &
+                             (UserAvailability.dt < end) &
+                             (UserAvailability.weekly |
+                              (UserAvailability.end > start) |
+                              (UserAvailability.dt > start - APPOINTMENT_DURATION))))
+    for availability in availabilities:
+        intervals[availability._data['user']].extend(expand(availability, start, end))
+    if not all(intervals.values()):
+        return []  # someone isn't available at all
+
+    busy = merge((appointment_start, appointment_start + APPOINTMENT_DURATION)
+                 for appointment_start, in (Appointment
+                                            .select(Appointment.dt)
+                                            .where((Appointment.dt > start - APPOINTMENT_DURATION) &
+                                                   (Appointment.dt < end))
+                                            .tuples()))
+    slots = []
+    for slot in common([merge(user_intervals) for user_intervals in intervals.values()],
+                       busy, duration):
+        slots.append(slot)
+        if len(slots) == k:
+            break
+    return slots
@@ -0,0 +1,108 @@
+import itertools
+import json
+import platform
+import random
+import subprocess
+import time
+from datetime import datetime
+from statistics import mean
+from statistics import median
+from realestate import app
+from realestate.celery import prepare_caches
+from realestate.celery import add_from_json
+from realestate.celery import rescore
+from realestate.forms import LoginForm
+from realestate.models import Realestate
+from realestate.synthetic import environment
+from realestate.synthetic import generate
+from realestate.synthetic import listing
+from realestate.synthetic import form_name
+from realestate.synthetic import PASSWORD
+
+"""
+Benchmarks for the hot paths, on synthetic data of several sizes.
+
+    python manage.py benchmark --sizes 100,1000 --output before.json
+
+Results are written as JSON (milliseconds per run), along with the
+commit they were measured on, so two runs can simply be diffed.
+"""
+
+SIZES = [100, 1000]
+REPEAT = 5
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def login(client, username, password=PASSWORD):
+    response = client.post('/login/', data={'formname': form_name(LoginForm),
+                                            'username': username,
+                                            'password': password})
+    if response.status_code != 302:
+        raise BenchmarkError("Could not log in as {}".format(username))
+
+
+def get(client, url):
+    def request():
+        response = client.get(url)
+        if response.status_code >= 400:
+            raise BenchmarkError("GET {} returned {}".format(url, response.status_code))
+    return request
+
+
+def timed(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return {'runs': repeat,
+            'min': round(min(durations) * 1000, 3),
+            'median': round(median(durations) * 1000, 3),
+            'mean': round(mean(durations) * 1000, 3),
+            'max': round(max(durations) * 1000, 3)}
+
+
+def benchmark_size(size, repeat=REPEAT, users=5, criteria=3, seed=0):
+    with environment():
+        usernames = generate(properties=size, users=users, criteria=criteria, seed=seed)
+        client = app.test_client()
+        login(client, usernames[0])
+        prepare_caches()
+        get(client, '/properties/')()  # runs the before_first_request hooks
+        realestate_id = Realestate.select(Realestate._id).order_by(Realestate._id).scalar()
+
+        rng = random.Random(seed)
+        new_listings = (json.dumps(listing(rng, i)) for i in itertools.count(size))
+        return {
+            'GET /properties/': timed(get(client, '/properties/'), repeat),
+            'GET /queue/': timed(get(client, '/queue/'), repeat),
+            'GET /property/<id>/': timed(get(client, '/property/{}/'.format(realestate_id)),
+                                         repeat),
+            'prepare_caches': timed(prepare_caches, repeat),
+            'add_from_json': timed(lambda: add_from_json(next(new_listings)), repeat),
+            'rescore': timed(rescore, repeat),  # the whole chord, eagerly
+        }
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes=SIZES, repeat=REPEAT, **kwargs):
+    return {'commit': commit(),
+            'python': platform.python_implementation() + ' ' + platform.python_version(),
+            'date': datetime.now().isoformat(),
+            'results': {str(size): benchmark_size(size, repeat, **kwargs)
+                        for size in sizes}}
+
+
+def write(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
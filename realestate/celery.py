@@ -1,6 +1,10 @@
 import json
+import time
+from datetime import timedelta
 from peewee import IntegrityError
 from celery import Celery
+from celery import chord
+from kombu import Queue
 from realestate import app
 
 from realestate.models import Realestate
@@ -11,19 +15,56 @@ from realestate.models import RealestateCriterionScore
 from realestate.models import Feature
 from realestate.models import RealestateFeature
 from realestate.models import User
+from realestate.models import Notification
 from realestate.models import database
+from realestate.models import r
+from realestate.models import publish
+from realestate import snapshot
+from realestate import activity
+from realestate import duplicates
 
 
+QUEUES = ['ingestion', 'scoring', 'cache', 'notifications']
+TASK_QUEUES = {
+    'add_from_json': 'ingestion',
+    'refresh_snapshot': 'cache',
+    'prepare_caches': 'cache',
+    'fan_out_notifications': 'notifications',
+    'rescore': 'scoring',
+    'rescore_chunk': 'scoring',
+    'retry_rescore': 'scoring',
+    'rescore_finished': 'cache',
+    'reparse_information': 'scoring',
+    'generate_feed': 'cache',
+}
+
 celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
 celery.conf.update(app.config)
+celery.conf.update(
+    CELERY_QUEUES=[Queue(queue, routing_key=queue) for queue in QUEUES],
+    CELERY_DEFAULT_QUEUE='ingestion',
+    CELERY_ROUTES={__name__ + '.' + task: {'queue': queue, 'routing_key': queue}
+                   for task, queue in TASK_QUEUES.items()},
+    CELERYBEAT_SCHEDULE={'generate_feed': {'task': __name__ + '.generate_feed',
+                                           'schedule': timedelta(hours=1)}})
 
 
 @celery.task
-@database.atomic()
 def add_from_json(r):
+    realestate = _add_from_json(r)
+    if realestate is not None:
+        duplicates.link(realestate)
+        refresh_snapshot.delay()
+        publish("property_added", {"_id": realestate._id,
+                                   "town": realestate.town,
+                                   "price": realestate.price,
+                                   "realestate_type": realestate.realestate_type})
+
+
+@database.atomic()
+def _add_from_json(r):
     r = json.loads(r)
-    urls = [realestate.realo_url for realestate in Realestate.select()]
-    if r["realo_url"] in urls:
+    if Realestate.select().where(Realestate.realo_url == r["realo_url"]).exists():
         return
     try:
         inhabitable_area, total_area = r["area"]
@@ -45,14 +86,17 @@ def add_from_json(r):
     except IntegrityError:
         return
 
+    values = {}
     for information in r["information"]:
         category, _ = (RealestateInformationCategory
                        .get_or_create(_realo_name=information[0]))
+        values[category._id] = information[1]  # one per category; the last one wins
 
+    for category_id, value in values.items():
         RealestateInformation.create(
             realestate=realestate,
-            category=category,
-            value=information[1])
+            category=category_id,
+            value=value)
 
     for criterion in RealestateCriterion.select():
         RealestateCriterionScore.create(criterion=criterion,
@@ -62,13 +106,156 @@ def add_from_json(r):
         feature, _ = Feature.get_or_create(name=feature)
         RealestateFeature.create(feature=feature, realestate=realestate)
 
+    return realestate
+
+
+@celery.task
+def refresh_snapshot(full=False):
+    snapshot.refresh(full=full)
+
 
 @celery.task
 @database.atomic()
 def prepare_caches():
+    current = snapshot.refresh()
     for user in User.select():
-        cached_queue = sorted(Realestate.full_queue(user),
-                              key=lambda x: (-x.score, -x._score))
+        queue_ids = [_id for _id, in (Realestate.full_queue(user)
+                                      .select(Realestate._id)
+                                      .tuples())]
+        cached_queue = current.ids(current.order('score', 'raw_score',
+                                                 mask=current.isin(queue_ids)))
         for _ in range(len(user.cached_queue)):  # empty current queue; REFACTOR!
             user.cached_queue.pop()
-        user.cached_queue.extend([x._id for x in cached_queue])  # add new items to queue
+        if cached_queue:
+            user.cached_queue.extend(cached_queue)  # add new items to queue
+
+
+@celery.task
+def fan_out_notifications(category, realestate_id, object_id, author_id):
+    Notification.fan_out(category,
+                         Realestate.get(Realestate._id == realestate_id),
+                         object_id,
+                         User.get(User._id == author_id))
+
+
+@celery.task
+def generate_feed(max_age=2):
+    activity.generate_feed(max_age=max_age)
+
+
+RESCORE_KEY = "realestate:rescore"  # hash with the progress of the latest rescore
+RESCORE_FAILED_KEY = "realestate:rescore:failed"  # set of chunks (as JSON) that failed
+RESCORE_CHUNK_SIZE = 200
+
+
+@celery.task
+def rescore(chunk_size=RESCORE_CHUNK_SIZE):
+    """
+    Recompute the default scores of all properties, in chunks that
+    run in parallel, each in its own short transaction. The queues
+    are rebuilt once, when all chunks are done.
+    """
+    ids = [_id for _id, in Realestate.select(Realestate._id).order_by(Realestate._id).tuples()]
+    chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+    pipe = r.pipeline()
+    pipe.delete(RESCORE_KEY, RESCORE_FAILED_KEY)
+    pipe.hmset(RESCORE_KEY, {'total': len(ids), 'done': 0, 'failed': 0,
+                             'started': time.time()})
+    pipe.execute()
+    _run_chunks(chunks)
+
+
+@celery.task
+def retry_rescore():
+    """
+    Rerun only the chunks that failed in the latest rescore
+    """
+    chunks = [json.loads(chunk.decode()) for chunk in r.smembers(RESCORE_FAILED_KEY)]
+    if not chunks:
+        return
+    pipe = r.pipeline()
+    pipe.delete(RESCORE_FAILED_KEY)
+    pipe.hset(RESCORE_KEY, 'failed', 0)
+    pipe.hdel(RESCORE_KEY, 'finished')
+    pipe.execute()
+    _run_chunks(chunks)
+
+
+def _run_chunks(chunks):
+    if not chunks:
+        rescore_finished.delay([])
+        return
+    chord(rescore_chunk.s(chunk) for chunk in chunks)(rescore_finished.s())
+
+
+@celery.task(bind=True, max_retries=3, default_retry_delay=10)
+def rescore_chunk(self, ids):
+    """
+    A failed chunk is retried a few times, then recorded for
+    retry_rescore; it doesn't fail the chord, so the queues are
+    still rebuilt for the other chunks.
+    """
+    try:
+        with database.atomic():
+            scores = (RealestateCriterionScore
+                      .select(RealestateCriterionScore, RealestateCriterion, Realestate)
+                      .join(RealestateCriterion)
+                      .switch(RealestateCriterionScore)
+                      .join(Realestate)
+                      .where(RealestateCriterionScore.realestate << ids))
+            for score in scores:
+                score.get_defaults()
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e)
+        pipe = r.pipeline()
+        pipe.sadd(RESCORE_FAILED_KEY, json.dumps(ids))
+        pipe.hincrby(RESCORE_KEY, 'failed', len(ids))
+        pipe.execute()
+        return 0
+    r.hincrby(RESCORE_KEY, 'done', len(ids))
+    return len(ids)
+
+
+@celery.task
+def reparse_information(category_id):
+    """
+    Parse the values of an information category again, and rescore
+    the properties that have one
+    """
+    realestate_ids = RealestateInformationCategory.get(_id=category_id).reparse()
+    for start in range(0, len(realestate_ids), RESCORE_CHUNK_SIZE):
+        with database.atomic():
+            for score in (RealestateCriterionScore
+                          .select()
+                          .where(RealestateCriterionScore.realestate <<
+                                 realestate_ids[start:start + RESCORE_CHUNK_SIZE])):
+                score.get_defaults()
+
+
+@celery.task
+def rescore_finished(results):
+    prepare_caches()
+    r.hset(RESCORE_KEY, 'finished', time.time())
+
+
+def rescore_progress():
+    """
+    Progress of the latest rescore: properties done, failed and in
+    total, and the estimated seconds left (None once it's finished)
+    """
+    progress = {key.decode(): float(value)
+                for key, value in r.hgetall(RESCORE_KEY).items()}
+    if not progress:
+        return None
+    total, done, failed = (int(progress.get(key, 0)) for key in ('total', 'done', 'failed'))
+    elapsed = progress.get('finished', time.time()) - progress.get('started', time.time())
+    if 'finished' in progress:
+        eta = None
+    elif done:
+        eta = round(elapsed / done * (total - done - failed), 1)
+    else:
+        eta = None  # no estimate before the first chunk is done
+    return {'total': total, 'done': done, 'failed': failed,
+            'elapsed': round(elapsed, 1), 'eta': eta,
+            'finished': 'finished' in progress}
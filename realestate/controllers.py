@@ -1,4 +1,6 @@
 import json
+import time
+import hashlib
 from functools import wraps
 from flask import redirect
 from flask import request
@@ -7,6 +9,11 @@ from flask import flash
 from flask import render_template
 from flask import abort
 from flask import jsonify
+from flask import Response
+from flask import stream_with_context
+from flask import make_response
+from flask import session
+from flask import g
 from peewee import DoesNotExist
 from peewee import SelectQuery
 from flask_login import login_required
@@ -23,25 +30,52 @@ from realestate.forms import RealestateCriterionForm
 from realestate.forms import MessageForm
 from realestate.forms import AppointmentForm
 from realestate.forms import AppointmentsForm
+from realestate.forms import UserAvailabilityForm
+from realestate.forms import RescoreForm
 from realestate.forms import RealestateCriterionScoreForm
 from realestate.forms import RealestateInformationCategoryForm
 from realestate.forms import AdminUserForm
 from realestate.forms import RealestateInformationForm
 from realestate.models import User
-from realestate.models import Realestatetate
+from realestate.models import Realestate
 from realestate.models import Notification
-from realestate.models import RealestatetateCriterion
+from realestate.models import RealestateCriterion
 from realestate.models import Message
 from realestate.models import Appointment
-from realestate.models import RealestatetateInformation
-from realestate.models import RealestatetateCriterionScore
-from realestate.models import RealestatetateInformationCategory
-from realestate.models import UserRealestatetateReview
+from realestate.models import UserAvailability
+from realestate.models import RealestateInformation
+from realestate.models import RealestateCriterionScore
+from realestate.models import RealestateInformationCategory
+from realestate.models import UserRealestateReview
+from realestate.models import Town
+from realestate.models import database
 from realestate.models import fn
 from realestate.models import cache
+from realestate.models import change_counters
+from realestate.models import url_counter
+from realestate.models import counters
+from realestate.models import epoch
+from realestate.models import ical_counter
 from realestate.celery import prepare_caches
 from realestate.celery import add_from_json
+from realestate.celery import rescore as rescore_task
+from realestate.celery import retry_rescore
+from realestate.celery import rescore_progress
+from realestate.celery import generate_feed
+from realestate.celery import reparse_information
+from realestate import snapshot
+from realestate.facets import FacetedQuery
+from realestate import search as fulltext
+from realestate import events as event_stream
+from realestate import fragments
+from realestate import sync
+from realestate import export as bulk_export
+from realestate import availability as common_availability
+from realestate import ical
+from realestate import activity as activity_feed
+from realestate.hooks import recent_requests
 from datetime import datetime
+from datetime import timedelta
 from config import CRON_PASSWORD
 
 
@@ -63,13 +97,13 @@ def admin_required(func):
     return decorated_view
 
 
-def ownership_required(model):
+def ownership_required(model, owner='author'):
     def outer(func):
         @wraps(func)
         def inner(*args, **kwargs):
             instance = model.get(model._id == kwargs['_id'])
             if not (current_user.is_admin or
-                    instance.author == current_user):  # EDIT!
+                    instance._data[owner] == current_user._id):
                 return abort(403)
             return func(*args, **kwargs)
         return inner
@@ -80,12 +114,66 @@ def cron_required(func):
     @wraps(func)
     def decorated_view(*args, **kwargs):
         auth = request.authorization
-        if not (auth or auth.username == "cron" or auth.password == CRON_PASSWORD):
+        if not (auth and auth.username == "cron" and auth.password == CRON_PASSWORD):
             return abort(401)
         return func(*args, **kwargs)
     return decorated_view
 
 
+CSRF_BUCKET = app.config.get('WTF_CSRF_TIME_LIMIT', 3600) // 2
+
+
+def conditional(version, forms=False):
+    """
+    Weak ETags for GET requests. version(user_id) returns the cheap
+    counters the page depends on; they are read before the view, or
+    any query, runs, and an unchanged page is answered with 304 Not
+    Modified. Pages with flashed messages are never tagged, and pages
+    with forms only for as long as their CSRF token is sure to be
+    valid. Goes above login_required, which would load the user.
+    A view that rendered older data than the counters say calls
+    untagged(), so its page isn't cached under their tag.
+    """
+    def outer(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            if request.method != 'GET' or '_flashes' in session:
+                return func(*args, **kwargs)
+            user_id = session.get('user_id', session.get('_user_id'))
+            parts = [epoch(), request.full_path, user_id, version(user_id)]
+            if forms:
+                parts += [session.get('csrf_token'), int(time.time() // CSRF_BUCKET)]
+            tag = hashlib.sha1(repr(parts).encode()).hexdigest()
+            cache_control = 'private, no-cache' if user_id else 'no-cache'
+            if request.if_none_match.contains_weak(tag):
+                response = Response(status=304)
+            else:
+                response = make_response(func(*args, **kwargs))
+                if (response.status_code != 200 or '_flashes' in session or
+                        getattr(g, 'untagged', False)):
+                    return response
+            response.set_etag(tag, weak=True)
+            response.headers['Cache-Control'] = cache_control
+            return response
+        return inner
+    return outer
+
+
+def untagged():
+    g.untagged = True
+
+
+def page_version(*names):
+    """
+    The version of a page with the navbar (user names, unread
+    notifications), that also depends on the counters in names
+    """
+    def version(user_id):
+        return (change_counters(),
+                counters("notifications:{}".format(user_id), *names))
+    return version
+
+
 ERROR_MESSAGES = {
     401: "You are unauthenticated",
     403: "You are not authorised to access this page",
@@ -136,8 +224,41 @@ def login():
 
 
 @app.route('/urls/')
+@cron_required
+@conditional(lambda user_id: url_counter())
 def urls():
-    return jsonify([r.realo_url for r in Realestate.select()])
+    """
+    All URLs at once; see sync_urls for the incremental version
+    """
+    urls = Realestate.select(Realestate.realo_url).tuples()
+    return Response(json.dumps([url for url, in urls.iterator()]),
+                    mimetype='application/json')
+
+
+@app.route('/sync/urls/')
+@cron_required
+def sync_urls():
+    """
+    The URLs added, sold or deleted since ?cursor=, as JSON lines;
+    the last line holds the cursor for the next sync.
+    """
+    return Response(stream_with_context(sync.changes(request.args.get('cursor'))),
+                    mimetype='application/x-ndjson')
+
+
+@app.route('/sync/urls/bloom/')
+@cron_required
+def sync_urls_bloom():
+    """
+    A Bloom filter of all URLs (see utils.BloomFilter), to be
+    followed by /sync/urls/?cursor=<X-Sync-Cursor>
+    """
+    bloom, cursor = sync.bloom_filter()
+    return Response(bloom.to_bytes(),
+                    mimetype='application/octet-stream',
+                    headers={'X-Bloom-Bits': str(bloom.bits),
+                             'X-Bloom-Hashes': str(bloom.hashes),
+                             'X-Sync-Cursor': cursor})
 
 
 @app.route('/logout/')
@@ -191,8 +312,7 @@ def prepare_cache():
 @login_required
 def mark_as_sold(_id):
     re = Realestate.get(Realestate._id == _id)
-    re.sold = True
-    re.save()
+    re.mark_as_sold()
     flash("The property in {} has been marked as sold!".format(re.address))
     return redirect(url_for('properties'))
 
@@ -201,10 +321,79 @@ def mark_as_sold(_id):
 @app.route('/generate_feed/', defaults={'max_age': 2})
 @admin_required
 def feed(max_age):
-    generate_feed(max_age=max_age)
+    generate_feed.delay(max_age=max_age)
     return "Generating..."
 
 
+@app.route("/activity/")
+@login_required
+def activity():
+    try:
+        before = float(request.args['before'])
+    except (KeyError, ValueError):
+        before = None
+    entries = activity_feed.timeline(current_user._id, before)
+    next_cursor = entries[-1]['ts'] if len(entries) == activity_feed.PAGE_SIZE else None
+    return render_template('activity.html',
+                           entries=entries,
+                           next_cursor=next_cursor)
+
+
+@app.route('/rescore/', methods=["GET", "POST"])
+@admin_required
+def rescore():
+    """
+    The progress of the latest rescore (as JSON with ?format=json),
+    and a form to start one or to rerun its failed chunks
+    """
+    form = RescoreForm()
+    if form.validate_on_submit():
+        if form.retry.data:
+            retry_rescore.delay()
+        else:
+            rescore_task.delay()
+        return redirect(url_for('rescore'))
+    progress = rescore_progress()
+    if request.args.get('format') == 'json':
+        return jsonify({"progress": progress})
+    if progress is None:
+        title = "Rescore"
+    else:
+        title = "Rescore: {done}/{total} done, {failed} failed".format(**progress)
+        if progress['eta'] is not None:
+            title += ", about {eta}s left".format(**progress)
+    return render_template('baseform.html', form=form, title=title)
+
+
+@app.route('/debug/sql/')
+@admin_required
+def debug_sql():
+    """
+    Query counts and N+1 suspects of the recently sampled requests.
+    ?suspects=1 only shows the requests with suspects.
+    """
+    requests = recent_requests()
+    if request.args.get('suspects'):
+        requests = [summary for summary in requests if summary['suspects']]
+    return jsonify({"requests": requests})
+
+
+@app.route('/export/properties.<format>')
+@admin_required
+def export(format):
+    """
+    All properties with their scores and status, streamed;
+    ?information=year,epc adds those information fields.
+    """
+    if format not in bulk_export.FORMATS:
+        abort(404)
+    information = [short for short in request.args.get('information', '').split(',') if short]
+    return Response(stream_with_context(bulk_export.export(format, information)),
+                    mimetype=bulk_export.FORMATS[format],
+                    headers={'Content-Disposition':
+                             'attachment; filename=properties.' + format})
+
+
 @app.route('/information/', methods=["GET", "POST"])
 @admin_required
 def information():
@@ -220,11 +409,29 @@ def information_detail(_id):
     item = RealestateInformationCategory.get(_id=_id)
     form = RealestateInformationCategoryForm(obj=item)
     if form.validate_on_submit():
+        value_type = item.value_type
         form.edit_object(item)
+        if item.value_type != value_type:
+            reparse_information.delay(item._id)
+            flash("The values of {} are being parsed again".format(item.name))
         return redirect(url_for('information'))
     return render_template("baseform.html", form=form)
 
 
+@app.route('/information/errors/')
+@admin_required
+def information_errors():
+    errors = (RealestateInformation
+              .select(RealestateInformation, Realestate, RealestateInformationCategory)
+              .join(Realestate)
+              .switch(RealestateInformation)
+              .join(RealestateInformationCategory)
+              .where(RealestateInformation.parse_error.is_null(False)))
+
+    return render_template("information_errors.html",
+                           errors=errors)
+
+
 
 @app.route('/settings/', methods=["GET", "POST"])
 @login_required
@@ -287,14 +494,28 @@ def undo_review(_id):
     return redirect(url_for('queue'))
 
 
+PROPERTIES_PER_PAGE = 12
+
+
 @app.route("/properties/", methods=['GET', 'POST'], defaults={"categories": ['house', 'land']})
 @app.route('/properties/<list:categories>/', methods=['GET', 'POST'])
+@conditional(page_version(), forms=True)
 @login_required
 def properties(categories):
     page_nr = int(request.args.get('page') or 1)
-    realestate = Realestate.not_rejected().where(Realestate.realestate_type << categories & ~Realestate.sold)
-    total_nr_of_pages = realestate.count() // 12 + 1
-    current_realestate = realestate#.paginate(page_nr, 12)
+    current = snapshot.current()
+    if current.stale:  # another worker is refreshing it
+        untagged()
+    not_rejected = Realestate.not_rejected().select(Realestate._id)
+    if request.args.get('town'):
+        not_rejected = not_rejected.where(Realestate.town == request.args['town'])
+    not_rejected = [_id for _id, in not_rejected.tuples()]
+    rows = current.order('status', 'score',
+                         mask=(current.mask(realestate_type=categories, sold=False) &
+                               current.isin(not_rejected)))
+    total_nr_of_pages = len(rows) // PROPERTIES_PER_PAGE + 1
+    page_ids = current.ids(rows[(page_nr - 1) * PROPERTIES_PER_PAGE:
+                                page_nr * PROPERTIES_PER_PAGE])
     previous_page = page_nr - 1 if page_nr > 1 else None
     next_page = page_nr + 1 if page_nr < total_nr_of_pages else None
 
@@ -312,13 +533,115 @@ def properties(categories):
         show_modal = False
 
     return render_template('houses_list.html',
-                           realestate=current_realestate,
+                           cards=fragments.cards(page_ids),
                            form=form,
                            show_modal=show_modal,
                            previous_page=previous_page,
                            next_page=next_page)
 
 
+@app.route('/properties/facets/')
+@login_required
+def facets():
+    """
+    Faceted search, e.g. /properties/facets/?price_max=250000&town=Leuven.
+    Returns a page of results together with the counts per facet value.
+    """
+    page_nr = int(request.args.get('page') or 1)
+    current = snapshot.current()
+    query = FacetedQuery.from_args(current, request.args)
+    rows = query.rows()
+    page = rows[(page_nr - 1) * PROPERTIES_PER_PAGE:page_nr * PROPERTIES_PER_PAGE]
+    page_ids = current.ids(page)
+    addresses = dict(Realestate
+                     .select(Realestate._id, Realestate.address)
+                     .where(Realestate._id << page_ids)
+                     .tuples())
+    results = [{"_id": _id,
+                "address": addresses.get(_id),
+                "url": url_for('realestate_detail', _id=_id),
+                "town": current.codes['town'][current['town'][row]],
+                "price": int(current['price'][row]),
+                "total_area": int(current['total_area'][row]),
+                "score": int(current['score'][row])}
+               for _id, row in zip(page_ids, page)]
+    return jsonify({"total": len(rows),
+                    "page": page_nr,
+                    "results": results,
+                    "facets": query.counts()})
+
+
+@app.route('/properties/near/')
+@app.route('/property/<int:_id>/nearby/')
+@login_required
+def nearby(_id=None):
+    """
+    Properties within ?km= (default 5) of a property or of ?lat=&lng=,
+    nearest first.
+    """
+    km = float(request.args.get('km') or 5)
+    if _id is not None:
+        realestate = get_object_or_404(Realestate, Realestate._id == _id)
+        lat, lng = realestate.lat, realestate.lng
+    else:
+        try:
+            lat, lng = float(request.args['lat']), float(request.args['lng'])
+        except (KeyError, ValueError):
+            abort(404)
+    if lat is None or lng is None:
+        return jsonify({"properties": []})
+    return jsonify({"properties": [{"_id": realestate._id,
+                                    "address": realestate.address,
+                                    "url": url_for('realestate_detail', _id=realestate._id),
+                                    "distance": round(distance, 3)}
+                                   for realestate, distance
+                                   in Realestate.within(lat, lng, km, limit=100)
+                                   if realestate._id != _id]})
+
+
+@app.route('/search/')
+@login_required
+def search():
+    text = request.args.get('q', '')
+    page_nr = int(request.args.get('page') or 1)
+    properties, more_properties = fulltext.search_properties(text, page_nr)
+    messages, more_messages = fulltext.search_messages(text, page_nr)
+    previous_page = page_nr - 1 if page_nr > 1 else None
+    next_page = page_nr + 1 if more_properties or more_messages else None
+    return render_template('search.html',
+                           text=text,
+                           properties=properties,
+                           messages=messages,
+                           previous_page=previous_page,
+                           next_page=next_page)
+
+
+@app.route('/events/')
+@login_required
+def events():
+    """
+    Server-sent events: new notifications, property status changes,
+    the length of the review queue and new properties.
+    """
+    user_id = current_user._id
+    database.close()  # the stream stays open for as long as the page does
+    return Response(stream_with_context(event_stream.stream(user_id)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+@app.route('/towns/')
+@login_required
+def towns():
+    return jsonify({"towns": [{"name": town.name,
+                               "postcode": town.postcode,
+                               "properties": town.property_count,
+                               "median_price_per_m2": town.median_price_per_m2,
+                               "accepted": town.accepted_count}
+                              for town in Town.select()]})
+
+
 @app.route('/property/<int:_id>/', methods=["GET", "POST"])
 @login_required
 def realestate_detail(_id):
@@ -376,8 +699,17 @@ def realestate_detail(_id):
         flash("This house has serious issues: " +
               ', '.join(dealbreaker.negative_description + (" (" + dealbreaker.safecomment + ")" if dealbreaker.safecomment else "")
                         for dealbreaker in realestate.dealbreakers), "warning")
+    try:
+        dt, message_id = request.args['messages_before'].split(',')
+        cursor = datetime.strptime(dt, CURSOR_FORMAT), int(message_id)
+    except (KeyError, ValueError):
+        cursor = None
+    messages, next_cursor = Message.thread(_id, cursor)
     return render_template('queue.html',
                            realestate=realestate,
+                           thread=zip(messages, fragments.bodies(messages)),
+                           messages_before=next_cursor and "{},{}".format(
+                               next_cursor[0].strftime(CURSOR_FORMAT), next_cursor[1]),
                            criterionscore_form=criterionscore_form,
                            message_form=message_form,
                            appointment_form=appointment_form,
@@ -385,14 +717,13 @@ def realestate_detail(_id):
 
 
 @app.route('/notification/<int:_id>/')
-@ownership_required(Notification)
+@ownership_required(Notification, owner='user')
 def notification(_id):
     url_endpoints = {'realestate': 'realestate_detail',
                      'message': 'message',
                      'appointment': 'appointment'}
     notification_object = Notification.get(_id=_id)
-    notification_object.read = True
-    notification_object.save()
+    notification_object.mark_as_read()
     return redirect(url_for('realestate_detail',
                             _id=notification_object.realestate._id,
                             _anchor=(notification_object.category +
@@ -436,32 +767,133 @@ def criterion(_id):
                            form=form)
 
 
+APPOINTMENT_WINDOW = timedelta(weeks=4)
+SUGGESTIONS_BUCKET = 15 * 60  # seconds
+
+
+def suggestions_start():
+    """
+    Suggestions start at the next quarter of an hour, so they only
+    change with the time every SUGGESTIONS_BUCKET seconds
+    """
+    return datetime.fromtimestamp((time.time() // SUGGESTIONS_BUCKET + 1) * SUGGESTIONS_BUCKET)
+
+
+def appointments_version(user_id):
+    return page_version("appointment", "availability", ical_counter(user_id))(user_id)
+
+
 @app.route('/appointments/', methods=["GET", "POST"])
+@conditional(lambda user_id: (appointments_version(user_id), suggestions_start()), forms=True)
 @login_required
 def appointments():
-    appointments = Appointment.select().order_by(Appointment.dt)
+    try:
+        start = datetime.strptime(request.args['from'], "%Y-%m-%d")
+    except (KeyError, ValueError):
+        start = datetime.combine(datetime.now().date(), datetime.min.time()) - timedelta(days=7)
+    end = start + APPOINTMENT_WINDOW
+    appointments = (Appointment
+                    .select(Appointment, Realestate)
+                    .join(Realestate)
+                    .where((Appointment.dt >= start) & (Appointment.dt < end))
+                    .order_by(Appointment.dt))
 
     form = AppointmentsForm()
     if form.validate_on_submit():
         appointment = form.create_object(Appointment)
-        realestate = Realestate.get(appointment.realestate)
-        Notification.create('appointment', realestate._id, realestate.town)
+        Notification.create('appointment', appointment.realestate, appointment._id)
         flash("Appointment made")
 
     return render_template('appointments.html',
                            appointments=appointments,
+                           suggestions=common_availability.suggest(start=suggestions_start()),
+                           previous=(start - APPOINTMENT_WINDOW).strftime("%Y-%m-%d"),
+                           next=end.strftime("%Y-%m-%d"),
+                           feed_url=url_for('appointments_feed',
+                                            user_id=current_user._id,
+                                            token=ical.token(current_user._id),
+                                            _external=True),
                            form=form)
 
 
+@app.route('/appointments/<int:user_id>/<token>.ics')
+def appointments_feed(user_id, token):
+    if not ical.verify(user_id, token):
+        abort(404)
+    if request.if_none_match.contains(ical.version()):
+        response = Response(status=304)
+    else:
+        body, version = ical.feed()
+        response = Response(body, mimetype='text/calendar')
+        response.set_etag(version)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@app.route('/appointments/feed/', methods=["POST"])
+@login_required
+def reset_appointments_feed():
+    ical.reset(current_user._id)
+    flash("Your calendar feed has a new address; the old one no longer works")
+    return redirect(url_for('appointments'))
+
+
+@app.route('/appointments/suggest/')
+@login_required
+def suggest_appointments():
+    """
+    The earliest k slots of at least duration minutes in the
+    next days when everyone is available
+    """
+    try:
+        k = min(int(request.args.get('k', 5)), 50)
+        duration = timedelta(minutes=int(request.args.get('duration', 60)))
+        days = min(int(request.args.get('days', 28)), 366)
+    except ValueError:
+        abort(400)
+    slots = common_availability.suggest(k=k, duration=duration, days=days)
+    return jsonify({"slots": [{"start": start.isoformat(), "end": end.isoformat()}
+                              for start, end in slots]})
+
+
+@app.route('/availability/', methods=["GET", "POST"])
+@login_required
+def availability():
+    form = UserAvailabilityForm()
+    if form.validate_on_submit():
+        form.create_object(UserAvailability, user=current_user._id)
+        flash("Availability added")
+        return redirect(url_for('availability'))
+
+    availabilities = (UserAvailability
+                      .select()
+                      .where(UserAvailability.user == current_user._id)
+                      .order_by(UserAvailability.dt))
+    return render_template('availability.html',
+                           availabilities=availabilities,
+                           form=form)
+
+
+CURSOR_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
 @app.route("/notifications/")
+@conditional(page_version())
 @login_required
 def notifications():
-    notifications = (Notification
-                     .select()
-                     .where(Notification.user == current_user._id))
+    try:
+        dt, _id = request.args['before'].split(',')
+        cursor = datetime.strptime(dt, CURSOR_FORMAT), int(_id)
+    except (KeyError, ValueError):
+        cursor = None
+    notifications, next_cursor = Notification.page_for(current_user, cursor)
+    if next_cursor:
+        next_cursor = "{},{}".format(next_cursor[0].strftime(CURSOR_FORMAT),
+                                     next_cursor[1])
 
     return render_template('notifications.html',
-                           notifications=notifications)
+                           notifications=notifications,
+                           next_cursor=next_cursor)
 
 
 @app.route("/message/<int:_id>/", methods=["GET", "POST"])
@@ -473,6 +905,7 @@ def message(_id):
     message_form = MessageForm(obj=message)
 
     if message_form.validate_on_submit():
+        message.edited += 1
         message_form.edit_object(message)
         return redirect(url_for('realestate_detail', _id=message.realestate._id))
 
@@ -1,5 +1,4 @@
 import functools
-import re
 from .utils import travel_time
 
 # DECORATORS
@@ -74,7 +73,7 @@ def time_by_car_to_leuven(house):
                 applies_to=['house'])
 @score
 def epc(house):
-    score = int(re.search("[0-9]+", house.epc).group(0))
+    score = int(house.typed('epc'))
     return 10 - (score - 150) // 60, house.epc
 
 
@@ -83,7 +82,7 @@ def epc(house):
                 applies_to=['house'])
 @score
 def cadastral_income(house):
-    return (int(int(house.cadastral_income.replace(".", "")[1:]) <= 745),
+    return (int(house.typed('cadastral_income') <= 745),
             house.cadastral_income)
 
 
@@ -111,7 +110,7 @@ def land_price(land):
                 applies_to=['house'])
 @score
 def year(house):
-    return 10 - (2016 - int(house.year)) // 4, house.year
+    return 10 - (2016 - int(house.typed('year'))) // 4, house.year
 
 
 @score_register(name="Spatial planning status of land",
@@ -0,0 +1,179 @@
+import random
+import re
+import struct
+import zlib
+from playhouse.signals import post_delete
+from realestate.models import r
+from realestate.models import touch
+from realestate.models import Realestate
+
+"""
+Near-duplicate listings: the same property listed by several sellers.
+
+A listing's address and description are reduced to word shingles and
+a MinHash signature, whose bands are stored in Redis under the
+listing's grid cell (about 500m). A new listing is only compared with
+the listings that share a band with it in its own or a neighbouring
+cell, so finding its duplicates doesn't depend on how many listings
+there are. Candidates whose signatures agree enough are linked to
+the oldest of them, their canonical property, and only that one is
+queued for review; its reviews count for all of them.
+
+Listings are indexed once they're committed (a rolled back id could
+be reused), and dropped from the index when they're deleted.
+"""
+
+NUM_HASHES = 64
+BANDS = 32  # of two rows: pairs with a similarity of 0.5 share a band 99.99% of the time
+SHINGLE_SIZE = 2  # words
+SIMILARITY_THRESHOLD = 0.5
+CELL_SIZE = 0.005  # degrees
+SIGNATURES_KEY = "realestate:minhash"
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(0)  # the same hash functions on every run
+_HASHES = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_HASHES)]
+
+
+def normalize(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+
+def shingles(realestate):
+    words = normalize(realestate.address) + normalize(realestate.description)
+    if len(words) < SHINGLE_SIZE:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def signature(shingle_set):
+    hashed = [zlib.crc32(shingle.encode()) for shingle in shingle_set]
+    return [min((a * value + b) % _PRIME for value in hashed) for a, b in _HASHES]
+
+
+def similarity(first, second):
+    """
+    Estimated Jaccard similarity of the shingles behind two signatures
+    """
+    return sum(x == y for x, y in zip(first, second)) / NUM_HASHES
+
+
+def cell(lat, lng):
+    return int(lat // CELL_SIZE), int(lng // CELL_SIZE)
+
+
+def _bucket_keys(cell_x, cell_y, sig):
+    rows = NUM_HASHES // BANDS
+    return ["realestate:lsh:{}:{}:{}:{:x}".format(
+                cell_x, cell_y, band,
+                zlib.crc32(struct.pack('>{}Q'.format(rows), *sig[band * rows:(band + 1) * rows])))
+            for band in range(BANDS)]
+
+
+def _pack(sig):
+    return struct.pack('>{}Q'.format(NUM_HASHES), *sig)
+
+
+def _unpack(data):
+    return struct.unpack('>{}Q'.format(NUM_HASHES), data)
+
+
+def index(realestate):
+    """
+    Add a listing to the buckets, and return its signature and
+    the ids of the listings it's likely a duplicate of
+    """
+    if realestate.lat is None or realestate.lng is None:
+        return None, []
+    sig = signature(shingles(realestate))
+    cell_x, cell_y = cell(realestate.lat, realestate.lng)
+    pipe = r.pipeline(transaction=False)
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for key in _bucket_keys(cell_x + dx, cell_y + dy, sig):
+                pipe.smembers(key)
+    candidates = {int(_id) for members in pipe.execute() for _id in members}
+    candidates.discard(realestate._id)
+
+    pipe = r.pipeline(transaction=False)
+    for key in _bucket_keys(cell_x, cell_y, sig):
+        pipe.sadd(key, realestate._id)
+    pipe.hset(SIGNATURES_KEY, realestate._id, _pack(sig))
+    pipe.execute()
+
+    if not candidates:
+        return sig, []
+    candidates = sorted(candidates)
+    signatures = r.hmget(SIGNATURES_KEY, candidates)
+    return sig, [_id for _id, data in zip(candidates, signatures)
+                 if data is not None and similarity(sig, _unpack(data)) >= SIMILARITY_THRESHOLD]
+
+
+def indexed(ids):
+    """
+    Which of the given ids are in the index
+    """
+    if not ids:
+        return set()
+    return {_id for _id, data in zip(ids, r.hmget(SIGNATURES_KEY, ids)) if data is not None}
+
+
+def link(realestate):
+    """
+    Link a committed listing to the canonical property of its
+    duplicates, if it has any that isn't sold yet. Returns the
+    canonical property's id.
+    """
+    _, duplicate_ids = index(realestate)
+    if not duplicate_ids:
+        return None
+    canonical_ids = {canonical_id or _id
+                     for _id, canonical_id in (Realestate
+                                               .select(Realestate._id, Realestate.canonical)
+                                               .where(Realestate._id << duplicate_ids)
+                                               .tuples())}
+    canonical_ids.discard(realestate._id)
+    canonical_ids = [_id for _id, in (Realestate
+                                      .select(Realestate._id)
+                                      .where((Realestate._id << list(canonical_ids)) &
+                                             ~Realestate.sold)
+                                      .tuples())] if canonical_ids else []
+    if not canonical_ids:
+        return None
+    canonical_id = min(canonical_ids)
+    (Realestate
+     .update(canonical=canonical_id)
+     .where(Realestate._id == realestate._id)
+     .execute())
+    realestate.canonical = canonical_id
+    touch(realestate._id)
+    return canonical_id
+
+
+def forget(realestate):
+    """
+    Drop a deleted listing from the index. Its duplicates, if it
+    was their canonical property, go back to being reviewed.
+    """
+    data = r.hget(SIGNATURES_KEY, realestate._id)
+    if data is not None:
+        cell_x, cell_y = cell(realestate.lat, realestate.lng)  # indexed, so it has coordinates
+        pipe = r.pipeline(transaction=False)
+        for key in _bucket_keys(cell_x, cell_y, _unpack(data)):
+            pipe.srem(key, realestate._id)
+        pipe.hdel(SIGNATURES_KEY, realestate._id)
+        pipe.execute()
+    orphans = [_id for _id, in (Realestate
+                                .select(Realestate._id)
+                                .where(Realestate.canonical == realestate._id)
+                                .tuples())]
+    if orphans:
+        Realestate.update(canonical=None).where(Realestate._id << orphans).execute()
+        for _id in orphans:
+            touch(_id)
+
+
+def realestate_deleted(sender, instance, *args):
+    forget(instance)
+
+post_delete.connect(realestate_deleted, sender=Realestate)
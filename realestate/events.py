@@ -0,0 +1,97 @@
+import json
+import threading
+from queue import Queue
+from queue import Empty
+from queue import Full
+from realestate import app
+from realestate.models import r
+from realestate.models import EVENTS_CHANNEL
+from realestate.models import events_channel
+
+"""
+Server-sent events.
+
+Every process keeps a single Redis subscription (pattern
+realestate:events*) in a background thread, and hands the messages
+to the queues of the clients connected to that process. An idle
+client therefore costs a queue and a sleeping generator, not a
+Redis or database connection. gunicorn_config.py runs gunicorn with
+gevent workers: with sync workers, every open page would hold a
+whole worker, and a few open tabs would take them all.
+"""
+
+HEARTBEAT = 25  # seconds; keeps proxies from closing idle connections
+CLIENT_BACKLOG = 100  # events a slow client may lag behind before they're dropped
+
+
+class Dispatcher:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}  # channel: set of queues
+        self.thread = None
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = r.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(EVENTS_CHANNEL + '*')
+                for message in pubsub.listen():
+                    self._dispatch(message)
+            except Exception:
+                # Redis restarting, most likely; resubscribe after a pause
+                app.logger.exception("Event subscription lost")
+                threading.Event().wait(1)
+
+    def _dispatch(self, message):
+        try:
+            channel = message['channel'].decode()
+            data = message['data'].decode()
+        except Exception:
+            app.logger.exception("Malformed event %r", message)
+            return
+        with self.lock:
+            queues = list(self.clients.get(channel, ()))
+        for queue in queues:
+            try:
+                queue.put_nowait(data)
+            except Full:
+                pass  # a slow client misses events rather than holding up the rest
+
+    def subscribe(self, channels):
+        queue = Queue(maxsize=CLIENT_BACKLOG)
+        with self.lock:
+            for channel in channels:
+                self.clients.setdefault(channel, set()).add(queue)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._listen, daemon=True)
+                self.thread.start()
+        return queue
+
+    def unsubscribe(self, queue, channels):
+        with self.lock:
+            for channel in channels:
+                self.clients.get(channel, set()).discard(queue)
+
+
+dispatcher = Dispatcher()
+
+
+def stream(user_id):
+    """
+    The event stream for a user: events for everyone and
+    events for that user only, in text/event-stream format.
+    """
+    channels = [events_channel(), events_channel(user_id)]
+    queue = dispatcher.subscribe(channels)
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                message = json.loads(queue.get(timeout=HEARTBEAT))
+            except Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield "event: {}\ndata: {}\n\n".format(message['event'],
+                                                   json.dumps(message['data']))
+    finally:
+        dispatcher.unsubscribe(queue, channels)
@@ -0,0 +1,127 @@
+import csv
+import io
+import json
+from itertools import islice
+from realestate.models import Realestate
+from realestate.models import RealestateInformation
+from realestate.models import RealestateInformationCategory
+from realestate import snapshot
+
+"""
+Streaming export of all properties, with their scores, status and
+information.
+
+Properties are read with a server-side cursor (tuples, no model
+instances) and enriched a batch at a time: scores and status come
+from the snapshot, information from one query per batch. Rows are
+yielded as soon as they're ready, so memory stays flat and the first
+line goes out right away.
+"""
+
+BATCH_SIZE = 500
+FIELDS = ['_id', 'realestate_type', 'added_on', 'address', 'postcode', 'town',
+          'price', 'inhabitable_area', 'total_area', 'lat', 'lng', 'seller',
+          'sold', 'visited', 'realo_url']
+SCORE_FIELDS = ['score', 'raw_score', 'status']
+FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+STATUS_NAMES = {rank: status for status, rank in snapshot.STATUS_RANKS.items()}
+
+
+def categories(shorts):
+    """
+    The information categories with the given short names, by id
+    """
+    return {category._id: category.short
+            for category in RealestateInformationCategory.select()
+            if category.short in shorts}
+
+
+def _scores(current, ids):
+    rows = current.positions(ids)
+    return {int(_id): {'score': int(score),
+                       'raw_score': int(raw_score),
+                       'status': STATUS_NAMES[int(status)]}
+            for _id, score, raw_score, status in zip(current['_id'][rows],
+                                                      current['score'][rows],
+                                                      current['raw_score'][rows],
+                                                      current['status'][rows])}
+
+
+def _information(ids, category_names):
+    information = {}
+    if not category_names:
+        return information
+    query = (RealestateInformation
+             .select(RealestateInformation.realestate,
+                     RealestateInformation.category,
+                     RealestateInformation.value)
+             .where((RealestateInformation.realestate << ids) &
+                    (RealestateInformation.category << list(category_names)))
+             .tuples())
+    for realestate_id, category_id, value in query:
+        information.setdefault(realestate_id, {})[category_names[category_id]] = value
+    return information
+
+
+def rows(information=()):
+    """
+    Every property as a dict: FIELDS, SCORE_FIELDS (None for properties
+    that aren't in the snapshot yet) and the requested information
+    """
+    current = snapshot.current()
+    category_names = categories(information)
+    query = (Realestate
+             .select(*[Realestate._meta.fields[field] for field in FIELDS])
+             .order_by(Realestate._id)
+             .tuples()
+             .iterator())
+    empty_scores = dict.fromkeys(SCORE_FIELDS)
+    while True:
+        batch = list(islice(query, BATCH_SIZE))
+        if not batch:
+            return
+        ids = [row[0] for row in batch]
+        scores = _scores(current, ids)
+        values = _information(ids, category_names)
+        for row in batch:
+            result = dict(zip(FIELDS, row))
+            result.update(scores.get(row[0], empty_scores))
+            for short in information:
+                result[short] = values.get(row[0], {}).get(short)
+            yield result
+
+
+def columns(information=()):
+    return FIELDS + SCORE_FIELDS + list(information)
+
+
+def _flush(buffer):
+    value = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return value
+
+
+def as_csv(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns)
+    writer.writeheader()
+    yield _flush(buffer)
+    for row in rows:
+        writer.writerow(row)
+        yield _flush(buffer)
+
+
+def as_jsonl(rows, columns):
+    for row in rows:
+        yield json.dumps(row, default=str) + "\n"
+
+
+def export(format='csv', information=()):
+    """
+    The export as a generator of text chunks
+    """
+    information = list(information)
+    writer = {'csv': as_csv, 'jsonl': as_jsonl}[format]
+    return writer(rows(information), columns(information))
@@ -0,0 +1,142 @@
+import numpy as np
+from realestate.snapshot import REALESTATE_TYPES
+from realestate.snapshot import STATUS_RANKS
+
+"""
+Faceted search over the property snapshot.
+
+Every facet filter is a boolean mask over the snapshot, i.e. a bitmap
+index. The counts for a facet are computed over the properties that
+match all *other* facets, so that a user can see how many results
+each alternative value would give (and widen a selection again).
+Counting is a bincount or a column sum over those bitmaps; there's
+no GROUP BY per facet.
+"""
+
+PRICE_BUCKETS = [0, 100000, 150000, 200000, 250000, 300000, 400000, np.inf]
+AREA_BUCKETS = [0, 250, 500, 1000, 2000, 5000, np.inf]
+
+STATUSES = sorted(STATUS_RANKS, key=STATUS_RANKS.get)
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _boolean(value):
+    if value in (None, ''):
+        return None
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def _bucket_label(low, high):
+    if high == np.inf:
+        return "{:,}+".format(int(low))
+    return "{:,}-{:,}".format(int(low), int(high))
+
+
+class FacetedQuery:
+    def __init__(self, snapshot, price=(None, None), area=(None, None),
+                 categories=None, towns=None, statuses=None, sellers=None,
+                 features=None, sold=None, visited=None):
+        self.snapshot = snapshot
+        self.price = price
+        self.area = area
+        self.categories = categories or []
+        self.towns = towns or []
+        self.statuses = statuses or []
+        self.sellers = sellers or []
+        self.features = features or []
+        self.sold = sold
+        self.visited = visited
+
+    @classmethod
+    def from_args(cls, snapshot, args):
+        """
+        Build a query from request arguments, e.g.
+        ?price_max=250000&town=Leuven&town=Heverlee&feature=Garage
+        """
+        return cls(snapshot,
+                   price=(_float(args.get('price_min')), _float(args.get('price_max'))),
+                   area=(_float(args.get('area_min')), _float(args.get('area_max'))),
+                   categories=args.getlist('category'),
+                   towns=args.getlist('town'),
+                   statuses=args.getlist('status'),
+                   sellers=args.getlist('seller'),
+                   features=args.getlist('feature'),
+                   sold=_boolean(args.get('sold')),
+                   visited=_boolean(args.get('visited')))
+
+    def masks(self):
+        """
+        One mask per active facet
+        """
+        conditions = {
+            'price': ('price', self.price if any(b is not None for b in self.price) else None),
+            'area': ('total_area', self.area if any(b is not None for b in self.area) else None),
+            'category': ('realestate_type', self.categories),
+            'town': ('town', self.towns),
+            'status': ('status', self.statuses),
+            'seller': ('seller', self.sellers),
+            'features': ('features', self.features),
+            'sold': ('sold', self.sold),
+            'visited': ('visited', self.visited),
+        }
+        return {facet: self.snapshot.mask(**{column: condition})
+                for facet, (column, condition) in conditions.items()
+                if condition not in (None, [])}
+
+    def _combined(self, masks, skip=None):
+        mask = np.ones(len(self.snapshot), dtype=np.bool_)
+        for facet, facet_mask in masks.items():
+            if facet != skip:
+                mask &= facet_mask
+        return mask
+
+    def rows(self):
+        """
+        Matching row numbers, best properties first
+        """
+        return self.snapshot.order('status', 'score', mask=self._combined(self.masks()))
+
+    def counts(self):
+        snapshot = self.snapshot
+        masks = self.masks()
+
+        def coded(facet, column, labels):
+            values = snapshot[column][self._combined(masks, skip=facet)]
+            counts = np.bincount(values, minlength=len(labels))
+            return {label: int(count)
+                    for label, count in zip(labels, counts)
+                    if count}
+
+        def bucketed(facet, column, buckets):
+            values = snapshot[column][self._combined(masks, skip=facet)]
+            counts, _ = np.histogram(values[~np.isnan(values)], bins=buckets)
+            return {_bucket_label(low, high): int(count)
+                    for low, high, count in zip(buckets, buckets[1:], counts)}
+
+        def boolean(facet, column):
+            values = snapshot[column][self._combined(masks, skip=facet)]
+            selected = int(values.sum())
+            return {'yes': selected, 'no': len(values) - selected}
+
+        feature_counts = snapshot['features'][self._combined(masks)].sum(axis=0)
+        statuses = coded('status', 'status', [None] + STATUSES)  # ranks start at 1
+        statuses.pop(None, None)
+        return {
+            'price': bucketed('price', 'price', PRICE_BUCKETS),
+            'area': bucketed('area', 'total_area', AREA_BUCKETS),
+            'category': coded('category', 'realestate_type', REALESTATE_TYPES),
+            'town': coded('town', 'town', snapshot.codes['town']),
+            'status': statuses,
+            'seller': coded('seller', 'seller', snapshot.codes['seller']),
+            'features': {name: int(count)
+                         for name, count in zip(snapshot.features, feature_counts)
+                         if count},
+            'sold': boolean('sold', 'sold'),
+            'visited': boolean('visited', 'visited'),
+        }
@@ -1,6 +1,7 @@
 import requests
 from flask import Markup
 from operator import attrgetter
+from datetime import datetime
 from realestate import app
 
 
@@ -42,6 +43,11 @@ def date(d):
     except AttributeError:
         return "?"
 
+
+@app.template_filter('timestamp')
+def timestamp(ts):
+    return datetime.fromtimestamp(ts).strftime("%d/%m/%Y %H:%M")
+
 def image_filter(s, width, height):
     replacement = "https://placeholdit.imgix.net/~text?txtsize=33&txt=350%C3%97150&w={}&h={}".format(str(width), str(height)) 
     try:
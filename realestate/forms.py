@@ -236,6 +236,10 @@ class MessageForm(BaseForm):
     body = PageDownField()
 
 
+class RescoreForm(BaseForm):
+    retry = BooleanField("Only rerun the chunks that failed last time")
+
+
 UserAvailabilityForm = generate_form(UserAvailability, exclude=["user"])
 AppointmentForm = generate_form(Appointment, exclude=["realestate"])
 AppointmentsForm = generate_form(Appointment)
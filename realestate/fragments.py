@@ -0,0 +1,76 @@
+from flask import Markup
+from flask import get_template_attribute
+from realestate import app
+from realestate.models import r
+from realestate.models import versions
+from realestate.models import Realestate
+
+"""
+Cache for rendered house cards and message bodies.
+
+A card only changes when its property changes (a save, a review,
+a rescore: everything that touches it) or when the generation
+moves on (a new user, a reweighted criterion). Cards are therefore
+cached under their property's version, and never invalidated: a
+new version simply misses, and old ones expire. Message bodies are
+Markdown, cached the same way under the number of times they were
+edited.
+"""
+
+CARD_TTL = 7 * 24 * 3600
+
+
+def card_key(_id, version):
+    seq, generation = version
+    return "realestate:card:{}:{}:{}".format(_id, seq, generation)
+
+
+def cards(ids):
+    """
+    The rendered cards of the given properties, in order. Only the
+    properties whose card isn't cached are loaded and rendered;
+    all of them are fetched from Redis in one round trip.
+    """
+    if not ids:
+        return []
+    keys = [card_key(_id, version) for _id, version in zip(ids, versions(ids))]
+    rendered = dict(zip(ids, r.mget(keys)))
+    missing = [_id for _id in ids if rendered[_id] is None]
+    if missing:
+        render = get_template_attribute('_housecard.html', 'render')
+        pipe = r.pipeline(transaction=False)
+        for realestate in Realestate.select().where(Realestate._id << missing):
+            card = str(render(realestate))
+            rendered[realestate._id] = card
+            pipe.set(keys[ids.index(realestate._id)], card, ex=CARD_TTL)
+        pipe.execute()
+    return [(_id, Markup(_text(rendered[_id])))
+            for _id in ids
+            if rendered[_id] is not None]  # deleted since the page was computed
+
+
+def _text(card):
+    return card.decode() if isinstance(card, bytes) else card
+
+
+def body_key(message):
+    return "realestate:message:{}:{}".format(message._id, message.edited)
+
+
+def bodies(messages):
+    """
+    The bodies of messages rendered as Markdown, in order,
+    fetched from Redis in one round trip
+    """
+    if not messages:
+        return []
+    keys = [body_key(message) for message in messages]
+    rendered = r.mget(keys)
+    markdown = app.jinja_env.filters['markdown']
+    pipe = r.pipeline(transaction=False)
+    for i, message in enumerate(messages):
+        if rendered[i] is None:
+            rendered[i] = str(markdown(message.body))
+            pipe.set(keys[i], rendered[i], ex=CARD_TTL)
+    pipe.execute()
+    return [Markup(_text(body)) for body in rendered]
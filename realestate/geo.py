@@ -0,0 +1,93 @@
+import numpy as np
+
+"""
+Grid index for radius queries on the property snapshot.
+
+The map is cut into cells of CELL_DEGREES by CELL_DEGREES; every
+property gets the key of its cell, and the snapshot stores the
+sorted cell keys along with the matching row numbers (see
+snapshot.DERIVED_COLUMNS). Keys are laid out so that the cells of
+one row of latitude are consecutive, so the candidates for a radius
+query are a handful of contiguous slices, found with binary search.
+The candidates are then refined with an exact (haversine) distance,
+vectorised.
+"""
+
+EARTH_RADIUS = 6371.0088  # km
+CELL_DEGREES = 0.05  # about 5.5km north-south, 3.5km east-west in Belgium
+_LNG_CELLS = int(round(360 / CELL_DEGREES)) + 1
+_NO_CELL = -1
+
+
+def index(lats, lngs):
+    """
+    The sorted cell keys and the row numbers in that order
+    """
+    keys = cells(lats, lngs)
+    by_cell = np.argsort(keys, kind='mergesort')
+    return keys[by_cell], by_cell
+
+
+def cells(lats, lngs):
+    """
+    Cell key of every (lat, lng); -1 where the location is unknown
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    known = ~(np.isnan(lats) | np.isnan(lngs))
+    keys = np.full(len(lats), _NO_CELL, dtype=np.int64)
+    rows = np.floor((lats[known] + 90) / CELL_DEGREES).astype(np.int64)
+    columns = np.floor((lngs[known] + 180) / CELL_DEGREES).astype(np.int64)
+    keys[known] = rows * _LNG_CELLS + columns
+    return keys
+
+
+def haversine(lat, lng, lats, lngs):
+    """
+    Great-circle distance in km from (lat, lng) to every (lats, lngs).
+    Within half a percent of geopy's vincenty, at a fraction of the cost.
+    """
+    lat, lng = np.radians(lat), np.radians(lng)
+    lats, lngs = np.radians(lats), np.radians(lngs)
+    a = (np.sin((lats - lat) / 2) ** 2 +
+         np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def candidates(snapshot, lat, lng, km):
+    """
+    Rows in the cells overlapping the bounding box of the circle
+    """
+    sorted_cells = snapshot['cell_keys']
+    delta_lat = np.degrees(km / EARTH_RADIUS)
+    cos_lat = max(np.cos(np.radians(lat)), 1e-6)
+    delta_lng = min(np.degrees(km / (EARTH_RADIUS * cos_lat)), 180)
+
+    first_row, last_row = (int(np.floor((lat + sign * delta_lat + 90) / CELL_DEGREES))
+                           for sign in (-1, 1))
+    first_column, last_column = (int(np.floor((lng + sign * delta_lng + 180) / CELL_DEGREES))
+                                 for sign in (-1, 1))
+    first_column, last_column = max(first_column, 0), min(last_column, _LNG_CELLS - 1)
+
+    slices = []
+    for row in range(max(first_row, 0), last_row + 1):
+        start = np.searchsorted(sorted_cells, row * _LNG_CELLS + first_column, side='left')
+        end = np.searchsorted(sorted_cells, row * _LNG_CELLS + last_column, side='right')
+        slices.append(snapshot['by_cell'][start:end])
+    if not slices:
+        return np.array([], dtype=np.int64)
+    return np.concatenate(slices)
+
+
+def within(snapshot, lat, lng, km, mask=None):
+    """
+    Rows within km of (lat, lng) and their distances, nearest first
+    """
+    rows = candidates(snapshot, lat, lng, km)
+    if mask is not None:
+        rows = rows[mask[rows]]
+    distances = haversine(lat, lng, snapshot['lat'][rows], snapshot['lng'][rows])
+    close = distances <= km
+    rows, distances = rows[close], distances[close]
+    order = np.argsort(distances, kind='mergesort')
+    return rows[order], distances[order]
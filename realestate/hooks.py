@@ -1,5 +1,12 @@
+import json
+import random
+from flask import g
+from flask import request
 from realestate import app, login_manager
-from realestate.models import database, User
+from realestate.models import database, User, r
+from realestate.instrumentation import QueryLog
+
+SQL_REQUESTS_KEY = "realestate:sql:requests"
 
 
 @app.before_request
@@ -7,6 +14,35 @@ def _db_connect():
     database.connect()
 
 
+@app.before_request
+def _sql_sample():
+    if app.debug or random.random() < app.config['SQL_SAMPLE_RATE']:
+        g.sql = QueryLog()
+
+
+@app.after_request
+def _sql_report(response):
+    log = getattr(g, 'sql', None)
+    if log is None:
+        return response
+    del g.sql
+    summary = log.summary()
+    response.headers['X-SQL-Count'] = str(summary['count'])
+    response.headers['X-SQL-Time'] = str(summary['time_ms'])
+    if summary['suspects']:
+        response.headers['X-SQL-N-Plus-One'] = str(len(summary['suspects']))
+        app.logger.warning("Possible N+1 queries in %s: %s",
+                           request.path, summary['suspects'])
+    summary.update(method=request.method,
+                   path=request.full_path.rstrip('?'),
+                   endpoint=request.endpoint)
+    pipe = r.pipeline(transaction=False)
+    pipe.lpush(SQL_REQUESTS_KEY, json.dumps(summary))
+    pipe.ltrim(SQL_REQUESTS_KEY, 0, app.config['SQL_RECENT_REQUESTS'] - 1)
+    pipe.execute()
+    return response
+
+
 @app.teardown_request
 def _db_close(exc):
     if not database.is_closed():
@@ -16,3 +52,11 @@ def _db_close(exc):
 @login_manager.user_loader
 def load_user(_id):
     return User.get(_id=_id)
+
+
+def recent_requests():
+    """
+    The SQL summaries of the most recently sampled requests, all workers
+    """
+    return [json.loads(summary.decode())
+            for summary in r.lrange(SQL_REQUESTS_KEY, 0, -1)]
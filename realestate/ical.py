@@ -0,0 +1,118 @@
+import hashlib
+import hmac
+from datetime import datetime
+from datetime import timedelta
+from realestate.models import r
+from realestate.models import Appointment
+from realestate.models import Realestate
+from realestate.models import APPOINTMENT_DURATION
+from realestate.models import bump_counters
+from realestate.models import counters
+from realestate.models import epoch
+from realestate.models import ical_counter
+from config import SECRET_KEY
+
+"""
+iCalendar feed of the appointments.
+
+Calendar clients can't log in, so every user gets a feed URL with
+an HMAC token instead. The token covers the user's id and their
+token counter, which reset() bumps to revoke the old URL, and the
+epoch, so all URLs change if Redis loses the counters. Deactivating
+a user resets their token, so checking it takes no query. The feed
+is the same for everyone: it's rendered once per version of the
+appointments and kept in Redis, and its version doubles as the ETag,
+so a client polling an unchanged feed is answered from Redis alone.
+"""
+
+FEED_KEY = "realestate:ical"
+FEED_TTL = 24 * 3600  # addresses can change without a new version
+PAST = timedelta(days=90)  # older appointments are left out
+
+
+def token(user_id):
+    message = "{}:{}:{}".format(user_id, epoch(), *counters(ical_counter(user_id)))
+    return hmac.new(SECRET_KEY.encode(), message.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def verify(user_id, given):
+    return hmac.compare_digest(token(user_id), given)
+
+
+def reset(user_id):
+    """
+    Give a user a new feed URL; the old one stops working
+    """
+    bump_counters(ical_counter(user_id))
+
+
+def version():
+    return "{}-{}".format(epoch(), *counters("appointment"))
+
+
+def _escape(text):
+    return (text.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+
+def _fold(line):
+    """
+    Lines are at most 75 octets; longer ones continue on the
+    next line after a space
+    """
+    encoded = line.encode()
+    parts = []
+    while len(encoded) > 75:
+        cut = 75 if not parts else 74
+        while cut and (encoded[cut] & 0xC0) == 0x80:  # don't split a character
+            cut -= 1
+        parts.append(encoded[:cut])
+        encoded = encoded[cut:]
+    parts.append(encoded)
+    return b"\r\n ".join(parts).decode()
+
+
+def _timestamp(dt):
+    return dt.strftime("%Y%m%dT%H%M%S")
+
+
+def render(appointments, now=None):
+    now = _timestamp((now or datetime.utcnow())) + "Z"
+    lines = ["BEGIN:VCALENDAR",
+             "VERSION:2.0",
+             "PRODID:-//realestate//appointments//EN",
+             "X-WR-CALNAME:Appointments"]
+    for _id, dt, address, town in appointments:
+        lines += ["BEGIN:VEVENT",
+                  "UID:appointment-{}@realestate".format(_id),
+                  "DTSTAMP:" + now,
+                  "DTSTART:" + _timestamp(dt),
+                  "DTEND:" + _timestamp(dt + APPOINTMENT_DURATION),
+                  "SUMMARY:" + _escape("Visit in {}".format(town or address or "?")),
+                  "LOCATION:" + _escape(address or ""),
+                  "END:VEVENT"]
+    lines.append("END:VCALENDAR")
+    return "".join(_fold(line) + "\r\n" for line in lines)
+
+
+def feed():
+    """
+    The feed and its version
+    """
+    current = version()
+    cached_version, body = r.hmget(FEED_KEY, 'version', 'body')
+    if cached_version is not None and cached_version.decode() == current:
+        return body.decode(), current
+
+    appointments = (Appointment
+                    .select(Appointment._id, Appointment.dt, Realestate.address, Realestate.town)
+                    .join(Realestate)
+                    .where(Appointment.dt >= datetime.now() - PAST)
+                    .order_by(Appointment.dt)
+                    .tuples())
+    body = render(appointments)
+    pipe = r.pipeline()
+    pipe.hmset(FEED_KEY, {'version': current, 'body': body})
+    pipe.expire(FEED_KEY, FEED_TTL)
+    pipe.execute()
+    return body, current
@@ -0,0 +1,82 @@
+import re
+import time
+from collections import defaultdict
+from flask import g
+from flask import has_app_context
+from playhouse.sqlite_ext import SqliteExtDatabase
+
+"""
+Per-request SQL instrumentation.
+
+The database records every query of a sampled request: the number of
+queries, the time spent and how often each statement fingerprint
+(the SQL with literals and IN lists collapsed) ran. A fingerprint
+that runs N_PLUS_ONE_THRESHOLD times or more in one request is most
+likely a query in a loop, e.g. through Realestate.__getattr__ or
+status. Requests that aren't sampled only pay for one attribute
+lookup per query.
+"""
+
+N_PLUS_ONE_THRESHOLD = 10
+
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _IN_LIST.sub('(...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+class QueryLog:
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.fingerprints = defaultdict(lambda: [0, 0.0])  # fingerprint: [count, time]
+
+    def record(self, sql, duration):
+        self.count += 1
+        self.total_time += duration
+        stats = self.fingerprints[fingerprint(sql)]
+        stats[0] += 1
+        stats[1] += duration
+
+    @property
+    def suspects(self):
+        """
+        Fingerprints that ran suspiciously often, most frequent first
+        """
+        return sorted(((sql, count, duration)
+                       for sql, (count, duration) in self.fingerprints.items()
+                       if count >= N_PLUS_ONE_THRESHOLD),
+                      key=lambda suspect: -suspect[1])
+
+    def summary(self):
+        return {'count': self.count,
+                'time_ms': round(self.total_time * 1000, 2),
+                'suspects': [{'sql': sql,
+                              'count': count,
+                              'time_ms': round(duration * 1000, 2)}
+                             for sql, count, duration in self.suspects]}
+
+
+def current_log():
+    if not has_app_context():
+        return None
+    return getattr(g, 'sql', None)
+
+
+class InstrumentedDatabase(SqliteExtDatabase):
+    def execute_sql(self, sql, params=None, require_commit=True):
+        log = current_log()
+        if log is None:
+            return super().execute_sql(sql, params, require_commit)
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, require_commit)
+        finally:
+            log.record(sql, time.perf_counter() - start)
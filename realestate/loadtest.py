@@ -0,0 +1,202 @@
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from base64 import b64encode
+from collections import defaultdict
+from realestate import app
+from realestate.celery import prepare_caches
+from realestate.forms import LoginForm
+from realestate.forms import MessageForm
+from realestate.synthetic import environment
+from realestate.synthetic import generate
+from realestate.synthetic import listing
+from realestate.synthetic import form_name
+from realestate.synthetic import PASSWORD
+from config import CRON_PASSWORD
+
+"""
+Closed-loop load test: a number of reviewers work through their
+queues at the same time (queue, review, now and then an undo), post
+messages and browse the properties, while a scraper posts new
+listings. Every simulated user waits for a response before sending
+the next request.
+
+Without a url, the app is driven through its test client, on
+synthetic data with fakeredis and eager Celery. With a url, a running
+server is driven over HTTP; its database must have been filled by
+`manage.py synthetic_data` first, so the users exist.
+"""
+
+REVIEW_LINK = re.compile(r'/review/\?[^"]*?_id=(\d+)')
+PROPERTY_LINK = re.compile(r'/property/(\d+)/')
+
+UNDO_CHANCE = 0.1
+MESSAGE_CHANCE = 0.1
+BROWSE_CHANCE = 0.2
+SCRAPER_INTERVAL = 1.0  # seconds between new listings
+
+
+class ClientTransport:
+    """
+    Requests through the Flask test client; one per simulated user
+    """
+    def __init__(self):
+        self.client = app.test_client()
+
+    def get(self, url):
+        response = self.client.get(url)
+        return response.status_code, response.get_data(as_text=True)
+
+    def post(self, url, data=None, json_body=None, auth=None):
+        headers = {}
+        if auth is not None:
+            headers['Authorization'] = 'Basic ' + b64encode(':'.join(auth).encode()).decode()
+        if json_body is not None:
+            response = self.client.post(url, data=json.dumps(json_body),
+                                        content_type='application/json',
+                                        headers=headers)
+        else:
+            response = self.client.post(url, data=data, headers=headers)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HttpTransport:
+    """
+    Requests over HTTP, e.g. to a local gunicorn
+    """
+    def __init__(self, url):
+        import requests  # only needed against a running server
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def get(self, url):
+        response = self.session.get(self.url + url, allow_redirects=False)
+        return response.status_code, response.text
+
+    def post(self, url, data=None, json_body=None, auth=None):
+        response = self.session.post(self.url + url, data=data, json=json_body,
+                                     auth=auth, allow_redirects=False)
+        return response.status_code, response.text
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def request(self, route, func, *args, **kwargs):
+        start = time.perf_counter()
+        status, body = func(*args, **kwargs)
+        duration = time.perf_counter() - start
+        with self.lock:
+            self.latencies[route].append(duration)
+            if status >= 400:
+                self.errors[route] += 1
+        return status, body
+
+    def report(self, elapsed):
+        return {route: {'requests': len(latencies),
+                        'errors': self.errors[route],
+                        'throughput': round(len(latencies) / elapsed, 2),
+                        'p50': percentile(latencies, 50),
+                        'p95': percentile(latencies, 95),
+                        'p99': percentile(latencies, 99)}
+                for route, latencies in sorted(self.latencies.items())}
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile, in milliseconds
+    """
+    values = sorted(values)
+    rank = max(int(round(p / 100 * len(values))) - 1, 0)
+    return round(values[rank] * 1000, 2)
+
+
+def reviewer(transport, recorder, username, deadline, rng):
+    recorder.request('POST /login/', transport.post, '/login/',
+                     data={'formname': form_name(LoginForm),
+                           'username': username,
+                           'password': PASSWORD})
+    previous = None
+    while time.perf_counter() < deadline:
+        _, page = recorder.request('GET /queue/', transport.get, '/queue/')
+        match = REVIEW_LINK.search(page)
+        if match is None:  # nothing left to review
+            _, page = recorder.request('GET /properties/', transport.get,
+                                       '/properties/?page={}'.format(rng.randint(1, 5)))
+            match = PROPERTY_LINK.search(page)
+            if match:
+                recorder.request('GET /property/<id>/', transport.get,
+                                 '/property/{}/'.format(match.group(1)))
+            continue
+        _id = match.group(1)
+
+        if rng.random() < MESSAGE_CHANCE:
+            recorder.request('POST /property/<id>/', transport.post,
+                             '/property/{}/'.format(_id),
+                             data={'formname': form_name(MessageForm),
+                                   'body': "Load test message from {}".format(username)})
+        if rng.random() < BROWSE_CHANCE:
+            recorder.request('GET /properties/', transport.get,
+                             '/properties/?page={}'.format(rng.randint(1, 5)))
+
+        status = rng.choice(['accepted', 'rejected', 'unsure'])
+        recorder.request('GET /review/', transport.get,
+                         '/review/?_id={}&status={}'.format(_id, status))
+        if previous is not None and rng.random() < UNDO_CHANCE:
+            recorder.request('GET /undo_review/<id>/', transport.get,
+                             '/undo_review/{}/'.format(previous))
+            previous = None
+        else:
+            previous = _id
+
+
+def scraper(transport, recorder, deadline, rng, first):
+    for i in itertools.count(first):
+        if time.perf_counter() >= deadline:
+            return
+        recorder.request('POST /post_new_realestate/', transport.post,
+                         '/post_new_realestate/',
+                         json_body=json.dumps(listing(rng, i)),
+                         auth=('cron', CRON_PASSWORD))
+        time.sleep(SCRAPER_INTERVAL)
+
+
+def drive(make_transport, usernames, duration, seed, first_listing):
+    recorder = Recorder()
+    start = time.perf_counter()
+    deadline = start + duration
+    threads = [threading.Thread(target=reviewer,
+                                args=(make_transport(), recorder, username, deadline,
+                                      random.Random(seed + n)))
+               for n, username in enumerate(usernames)]
+    threads.append(threading.Thread(target=scraper,
+                                    args=(make_transport(), recorder, deadline,
+                                          random.Random(seed), first_listing)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder.report(time.perf_counter() - start)
+
+
+def run(users=4, duration=30, url=None, properties=500, seed=0):
+    """
+    Per route: number of requests, errors, throughput (requests per
+    second) and p50/p95/p99 latency (ms)
+    """
+    usernames = ["user{}".format(n) for n in range(users)]
+    if url:
+        return drive(lambda: HttpTransport(url), usernames, duration, seed,
+                     first_listing=int(time.time()))  # new listings on every run
+    with environment():
+        generate(properties=properties, users=users, seed=seed)
+        prepare_caches()
+        ClientTransport().get('/login/')  # runs the before_first_request hooks once
+        return drive(ClientTransport, usernames, duration, seed,
+                     first_listing=properties)
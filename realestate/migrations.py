@@ -0,0 +1,266 @@
+import re
+from playhouse.migrate import SqliteMigrator
+from playhouse.migrate import migrate
+from peewee import fn
+from realestate.models import database
+from realestate.models import r
+from realestate.models import GENERATION_KEY
+from realestate.models import touch
+from realestate.models import Realestate
+from realestate.models import Town
+from realestate.models import Notification
+from realestate.models import Message
+from realestate.models import RealestateInformation
+from realestate.models import RealestateInformationCategory
+from realestate.models import RealestateCriterionScore
+from realestate.models import UserRealestateReview
+from realestate.models import UserAvailability
+from realestate.models import Appointment
+from realestate.models import APPOINTMENT_DURATION
+from realestate.utils import parse_address
+from realestate import search
+from realestate import duplicates as near_duplicates
+
+"""
+Schema changes for existing databases. New databases get the full
+schema from setup_database; these bring older ones up to date.
+Every migration is idempotent, so `manage.py migrate` can simply
+run all of them.
+"""
+
+migrator = SqliteMigrator(database)
+
+MIGRATIONS = []
+
+
+def migration(func):
+    MIGRATIONS.append(func)
+    return func
+
+
+def columns(model):
+    table = model._meta.db_table
+    return {row[1] for row in database.execute_sql('PRAGMA table_info("{}")'.format(table))}
+
+
+def add_index(model, field_names, unique=False):
+    """
+    Same name as the indexes peewee creates with the table,
+    so running this against a fresh database is a no-op.
+    """
+    table = model._meta.db_table
+    index_columns = [model._meta.fields[name].db_column for name in field_names]
+    database.execute_sql('CREATE {}INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(
+        'UNIQUE ' if unique else '',
+        '_'.join([table] + index_columns),
+        table,
+        ', '.join('"{}"'.format(column) for column in index_columns)))
+
+
+def add_columns(model, *field_names):
+    """
+    Add the given fields if they're missing.
+    Returns whether anything was added.
+    """
+    existing = columns(model)
+    fields = [model._meta.fields[name]
+              for name in field_names
+              if model._meta.fields[name].db_column not in existing]
+    if not fields:
+        return False
+    migrate(*[migrator.add_column(model._meta.db_table, field.db_column, field)
+              for field in fields])
+    for field in fields:
+        if field.index or field.unique:
+            add_index(model, [field.name], unique=field.unique)
+    return True
+
+
+def in_batches(query, size=500):
+    """
+    Yield query results in batches, each in its own short
+    transaction, instead of locking the database throughout.
+    """
+    model = query.model_class
+    last_id = 0
+    while True:
+        with database.atomic():
+            batch = list(query
+                         .where(model._id > last_id)
+                         .order_by(model._id)
+                         .limit(size))
+            if not batch:
+                return
+            yield batch
+        last_id = batch[-1]._id
+
+
+@migration
+def typed_information_values():
+    add_columns(RealestateInformationCategory, 'value_type')
+    add_columns(RealestateInformation, 'numeric_value', 'enum_value', 'parse_error')
+    from realestate.setup import setup_information  # registers the web app's startup hooks
+    setup_information()  # sets the value types of the builtin categories, which reparses them
+
+
+@migration
+def town_columns():
+    """
+    Only properties without a town are parsed, so an interrupted
+    run picks up where it stopped.
+    """
+    Town.create_table(fail_silently=True)
+    added = add_columns(Realestate, 'postcode', 'town')
+    missing = (Realestate
+               .select(Realestate._id, Realestate.address)
+               .where(Realestate.town.is_null() & Realestate.address.is_null(False)))
+    parsed = False
+    for batch in in_batches(missing):
+        for realestate in batch:
+            postcode, town = parse_address(realestate.address)
+            (Realestate
+             .update(postcode=postcode, town=town)
+             .where(Realestate._id == realestate._id)
+             .execute())
+            parsed = True
+    if added or parsed:
+        r.incr(GENERATION_KEY)  # the updates bypass the signals
+        Town.rebuild()
+
+
+@migration
+def search_indexes():
+    exists = database.execute_sql(
+        "SELECT 1 FROM sqlite_master WHERE name = 'realestate_search'").fetchone()
+    search.create_indexes()
+    if not exists:
+        search.rebuild_indexes()
+
+
+@migration
+def plain_notification_bodies():
+    """
+    Notifications used to store their own link in the body;
+    the link is now added when they are displayed.
+    """
+    query = Notification.select().where(Notification.body.contains('<a href'))
+    for batch in in_batches(query):
+        for notification in batch:
+            (Notification
+             .update(body=re.sub(r'<[^>]+>', '', notification.body).strip())
+             .where(Notification._id == notification._id)
+             .execute())
+
+
+@migration
+def notification_indexes():
+    for field_names, unique in Notification._meta.indexes:
+        add_index(Notification, field_names, unique)
+
+
+def duplicates(model, field_names, size=500):
+    """
+    Yield the ids of rows that share field_names, in batches of
+    groups. Every group is a list of ids, oldest first.
+    """
+    fields = [model._meta.fields[name] for name in field_names]
+    while True:
+        groups = (model
+                  .select(fn.GROUP_CONCAT(model._id))
+                  .group_by(*fields)
+                  .having(fn.COUNT(model._id) > 1)
+                  .limit(size)
+                  .tuples())
+        batch = [sorted(int(_id) for _id in ids.split(',')) for ids, in groups]
+        if not batch:
+            return
+        yield batch
+
+
+def dedupe(model, field_names, keep=lambda rows: rows[-1]):
+    """
+    Delete duplicate rows, keeping one per group (by default
+    the newest), one short transaction per batch of groups.
+    """
+    for batch in duplicates(model, field_names):
+        with database.atomic():
+            realestate_ids = set()
+            for ids in batch:
+                rows = list(model.select().where(model._id << ids).order_by(model._id))
+                kept = keep(rows)
+                (model
+                 .delete()
+                 .where((model._id << ids) & (model._id != kept._id))
+                 .execute())
+                realestate_ids.add(kept._data['realestate'])
+        for realestate_id in realestate_ids:
+            touch(realestate_id)  # the deletes bypass the signals
+
+
+def _scored_last(rows):
+    """
+    A score someone entered wins over a default one
+    """
+    return sorted(rows, key=lambda row: (row.score is not None, row._id))[-1]
+
+
+@migration
+def unique_indexes():
+    """
+    Reviews, criterion scores and information are looked up by
+    (realestate, user/criterion/category), and there must be one
+    of each. In WAL mode readers carry on while the indexes are
+    built; writers only wait for the index build itself.
+    """
+    database.execute_sql("PRAGMA journal_mode=WAL")
+    dedupe(UserRealestateReview, ['user', 'realestate'])
+    dedupe(RealestateCriterionScore, ['realestate', 'criterion'], keep=_scored_last)
+    dedupe(RealestateInformation, ['realestate', 'category'])
+    for model in (UserRealestateReview, RealestateCriterionScore, RealestateInformation):
+        for field_names, unique in model._meta.indexes:
+            add_index(model, field_names, unique)
+
+
+@migration
+def availability_intervals():
+    """
+    Availabilities used to be a single moment, which now stands for
+    an hour from then
+    """
+    if add_columns(UserAvailability, 'end', 'weekly', 'until'):
+        for batch in in_batches(UserAvailability.select().where(UserAvailability.end.is_null())):
+            for availability in batch:
+                (UserAvailability
+                 .update(end=availability.dt + APPOINTMENT_DURATION)
+                 .where(UserAvailability._id == availability._id)
+                 .execute())
+    add_index(UserAvailability, ['dt'])
+    add_index(Appointment, ['dt'])
+
+
+@migration
+def message_threads():
+    add_columns(Message, 'edited')
+    for field_names, unique in Message._meta.indexes:
+        add_index(Message, field_names, unique)
+
+
+@migration
+def canonical_properties():
+    """
+    Link the duplicates among the existing properties, oldest first.
+    Properties that are already indexed are skipped, so an interrupted
+    run picks up where it stopped.
+    """
+    add_columns(Realestate, 'canonical')
+    for batch in in_batches(Realestate.select()):
+        done = near_duplicates.indexed([realestate._id for realestate in batch])
+        for realestate in batch:
+            if realestate._id not in done:
+                near_duplicates.link(realestate)
+
+
+def run():
+    for func in MIGRATIONS:
+        print("Running {}...".format(func.__name__))
+        func()
@@ -1,14 +1,18 @@
 import os
 import re
+import json
+import time
+import threading
 from datetime import datetime
+from datetime import timedelta
 from functools import total_ordering
+from statistics import median
 from flask_login import UserMixin
 from flask_login import current_user
-from geopy.distance import vincenty
-from playhouse.sqlite_ext import SqliteExtDatabase
 from playhouse.signals import Model
 from playhouse.signals import post_init
 from playhouse.signals import post_save
+from playhouse.signals import post_delete
 from peewee import CharField
 from peewee import IntegrityError
 from peewee import BooleanField
@@ -25,6 +29,10 @@ from playhouse.hybrid import hybrid_method
 from playhouse.hybrid import hybrid_property
 from realestate import bcrypt
 from realestate.utils import to_snakecase
+from realestate.utils import parse_address
+from realestate.parsers import parse
+from realestate.parsers import VALUE_TYPES
+from realestate.instrumentation import InstrumentedDatabase
 import realestate.criteria_funcs
 from walrus import Database
 from redis import Redis
@@ -41,10 +49,245 @@ Note on terminology:
 
 r = Redis(port=REDIS_PORT, password=REDIS_PASSWORD)
 
-database = SqliteExtDatabase(os.path.join(ROOT, 'houses.db'))
+
+
+class HookedDatabase(InstrumentedDatabase):
+    """
+    Runs after_commit() callbacks once the outermost transaction
+    is committed, and drops them if it is rolled back. Outside a
+    transaction they run right away.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._hooks = threading.local()
+
+    def _pending(self):
+        if not hasattr(self._hooks, 'pending'):
+            self._hooks.pending = []
+        return self._hooks.pending
+
+    def after_commit(self, func, *args, **kwargs):
+        if self.transaction_depth() == 0:
+            func(*args, **kwargs)
+        else:
+            self._pending().append((func, args, kwargs))
+
+    def commit(self):
+        super().commit()
+        pending, self._hooks.pending = self._pending(), []
+        for func, args, kwargs in pending:
+            func(*args, **kwargs)
+
+    def rollback(self):
+        super().rollback()
+        self._hooks.pending = []
+
+
+database = HookedDatabase(os.path.join(ROOT, 'houses.db'))
 
 cache = Database(port=REDIS_PORT, password=REDIS_PASSWORD)
 
+CHANGES_KEY = "realestate:changes"
+CHANGED_KEY = "realestate:changed"
+GENERATION_KEY = "realestate:generation"
+
+_touch = r.register_script("""
+    local seq = redis.call('INCR', KEYS[1])
+    redis.call('ZADD', KEYS[2], seq, ARGV[1])
+    return seq
+    """)
+
+
+def touch(realestate_id):
+    """
+    Record that a property changed. Every property keeps the
+    sequence number of its latest change, so anything derived
+    from the realestate table can catch up incrementally.
+    """
+    return _touch(keys=[CHANGES_KEY, CHANGED_KEY], args=[realestate_id])
+
+
+URL_CHANGES_KEY = "realestate:urls:changes"
+URL_CHANGED_KEY = "realestate:urls:changed"
+
+
+def touch_url(realestate_id):
+    """
+    Record that the scraper's view of a property changed: it was
+    added, marked as sold or deleted. Kept apart from the general
+    change log, which reviews and rescores move on all the time.
+    """
+    return _touch(keys=[URL_CHANGES_KEY, URL_CHANGED_KEY], args=[realestate_id])
+
+
+def url_counter():
+    return int(r.get(URL_CHANGES_KEY) or 0)
+
+
+def changed_since(seq):
+    """
+    Ids of all properties changed after sequence number seq
+    """
+    return [int(_id) for _id in r.zrangebyscore(CHANGED_KEY, seq + 1, '+inf')]
+
+
+_adjust_existing = r.register_script("""
+    for _, key in ipairs(KEYS) do
+        if redis.call('EXISTS', key) == 1 then
+            redis.call('INCRBY', key, ARGV[1])
+        end
+    end
+    """)
+
+
+EVENTS_CHANNEL = "realestate:events"
+
+
+def events_channel(user_id=None):
+    """
+    The channel for everyone, or for one user only
+    """
+    if user_id is None:
+        return EVENTS_CHANNEL
+    return EVENTS_CHANNEL + ":" + str(user_id)
+
+
+def publish(event, data, user_ids=None):
+    """
+    Push a (small) event to the connected browsers, see events.py
+    """
+    message = json.dumps({"event": event, "data": data})
+    if user_ids is None:
+        r.publish(events_channel(), message)
+        return
+    pipe = r.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.publish(events_channel(user_id), message)
+    pipe.execute()
+
+
+ACTIVITY_KEY = "realestate:activity"
+ACTIVITY_SEQ_KEY = "realestate:activity:seq"
+
+
+def feed_key(user_id):
+    return "realestate:" + str(user_id) + ":feed"
+
+
+FEED_LENGTH = 1000  # entries kept per feed between compactions
+
+
+def record(kind, realestate, user=None, **data):
+    """
+    Append an entry to the activity log, and to the feed of every
+    active user but the one who did it, once the current transaction
+    is committed. Entries are scored by time and carry what's needed
+    to display them, so reading a feed is a single range read; see
+    activity.py.
+    """
+    entry = dict(data,
+                 kind=kind,
+                 ts=time.time(),
+                 realestate=realestate._id,
+                 town=realestate.town,
+                 address=realestate.address,
+                 user=user and user._id,
+                 username=user and user.username)
+    database.after_commit(_append, entry)
+
+
+def _append(entry):
+    entry['id'] = r.incr(ACTIVITY_SEQ_KEY)
+    member = json.dumps(entry, sort_keys=True)
+    pipe = r.pipeline(transaction=False)
+    pipe.zadd(ACTIVITY_KEY, member, entry['ts'])
+    for user_id, in User.select(User._id).where(User.active).tuples():
+        if user_id != entry['user']:
+            pipe.zadd(feed_key(user_id), member, entry['ts'])
+            pipe.zremrangebyrank(feed_key(user_id), 0, -FEED_LENGTH - 1)
+    pipe.execute()
+
+
+def unread_key(user_id):
+    return "realestate:" + str(user_id) + ":unread"
+
+
+def adjust_unread(user_ids, delta):
+    """
+    Counters that don't exist yet are left alone; they're
+    initialised from the database the first time they're read.
+    """
+    if user_ids:
+        _adjust_existing(keys=[unread_key(user_id) for user_id in user_ids],
+                         args=[delta])
+
+
+def change_counters():
+    """
+    The current (sequence number, generation). The generation is
+    bumped by changes that affect every property at once, such as
+    a new user or a reweighted criterion.
+    """
+    seq, generation = r.mget(CHANGES_KEY, GENERATION_KEY)
+    return int(seq or 0), int(generation or 0)
+
+
+def versions(ids):
+    """
+    The version of every given property: the sequence number of its
+    latest change (0 if it never changed) and the generation. A
+    property looks the same as long as its version is the same.
+    """
+    pipe = r.pipeline(transaction=False)
+    for _id in ids:
+        pipe.zscore(CHANGED_KEY, _id)
+    pipe.get(GENERATION_KEY)
+    *seqs, generation = pipe.execute()
+    generation = int(generation or 0)
+    return [(int(seq or 0), generation) for seq in seqs]
+
+
+EPOCH_KEY = "realestate:epoch"
+
+
+def counter_key(name):
+    return "realestate:version:" + name
+
+
+def bump_counters(*names):
+    pipe = r.pipeline(transaction=False)
+    for name in names:
+        pipe.incr(counter_key(name))
+    pipe.execute()
+
+
+def ical_counter(user_id):
+    """
+    Part of a user's calendar feed token; bumping it revokes the token
+    """
+    return "ical:{}".format(user_id)
+
+
+def counters(*names):
+    """
+    Version counters of things that aren't in the change log, such
+    as appointments ('appointment'), availabilities ('availability')
+    or a user's notifications ('notifications:<user id>')
+    """
+    return [int(value or 0) for value in r.mget([counter_key(name) for name in names])]
+
+
+def epoch():
+    """
+    A random value that lives as long as the counters: if Redis
+    loses them, they restart from 0, but under a new epoch.
+    """
+    value = r.get(EPOCH_KEY)
+    if value is None:
+        r.set(EPOCH_KEY, os.urandom(8).hex(), nx=True)
+        value = r.get(EPOCH_KEY)
+    return value.decode()
+
 
 class UserNotAvailableError(Exception):
     pass
@@ -143,18 +386,42 @@ class User(BaseModel, UserMixin):
     def cached_queue(self):
         return cache.List("realestate:" + str(self._id) + ":queue")
 
+    @property
+    def unread_count(self):
+        count = r.get(unread_key(self._id))
+        if count is None:
+            count = (Notification
+                     .select()
+                     .where((Notification.user == self._id) & ~Notification.read)
+                     .count())
+            r.set(unread_key(self._id), count, nx=True)
+        return int(count)
+
     def review_property(self, realestate_id, status):
         review, _ = UserRealestateReview.get_or_create(user=self._id,
                                                        realestate=realestate_id)
+        previous = review.status
         review.status = status
         review.save()
         r.lrem("realestate:" + str(self._id) + ":queue", realestate_id, num=1)
+        realestate = self.publish_review(realestate_id)
+        if status != previous:
+            record('review', realestate, self, status=status)
 
     def undo_review(self, realestate_id):
-        review = UserRealestateReview.get(UserRealestateReview.realestate == realestate_id &
-                                          UserRealestateReview.user == self._id)
+        review = UserRealestateReview.get((UserRealestateReview.realestate == realestate_id) &
+                                          (UserRealestateReview.user == self._id))
         review.delete_instance()
         self.cached_queue.prepend(realestate_id)
+        self.publish_review(realestate_id)
+
+    def publish_review(self, realestate_id):
+        realestate = Realestate.get(Realestate._id == realestate_id)
+        publish("status_changed", {"_id": realestate._id,
+                                   "status": realestate.status})
+        publish("queue_length", {"to_go": len(self.cached_queue)},
+                user_ids=[self._id])
+        return realestate
 
 
 class RealestateCriterion(BaseModel):
@@ -250,6 +517,10 @@ def rank_status(s):
     return r[s]
 
 
+NEARBY_DISTANCE = 5  # km
+NEARBY_LIMIT = 10
+
+
 class Realestate(BaseModel):
     realestate_type = CharField(choices=[('land', 'Land'),
                                        ('house', 'House')])
@@ -263,10 +534,14 @@ class Realestate(BaseModel):
     total_area = IntegerField()
 
     address = CharField()
+    postcode = CharField(null=True, index=True)
+    town = CharField(null=True, index=True)  # both derived from address on save
     lat = FloatField(null=True)
     lng = FloatField(null=True)
 
     realo_url = CharField(null=True, unique=True)
+    # the same property listed by another seller, which is reviewed instead
+    canonical = ForeignKeyField('self', null=True, index=True, related_name='duplicates')
     description = CharField(null=True)
 
     visited = BooleanField(default=False)
@@ -278,17 +553,58 @@ class Realestate(BaseModel):
     def __repr__(self):
         return self.address
 
+    def save(self, *args, **kwargs):
+        self._previous_town = self.town
+        if self.address:
+            self.postcode, self.town = parse_address(self.address)
+        return super().save(*args, **kwargs)
+
+    def mark_as_sold(self):
+        if self.sold:
+            return
+        self.sold = True
+        self.save()
+        database.after_commit(touch_url, self._id)
+        record('sold', self)
+
+    @classmethod
+    def in_town(cls, town):
+        return cls.select().where(cls.town == town)
+
     @hybrid_property
     def has_full_address(self):
         return bool(re.match(r'[\w\s\']+\s\d{1,4},\s\d{4}[\w\s\']+', self.address))
 
     @hybrid_method
     def distance_to(self, lat, lng):
+        from geopy.distance import vincenty  # slow to import, and rarely needed
         return vincenty((self.lat, self.lng), (lat, lng))
 
-    @hybrid_property
+    @classmethod
+    def within(cls, lat, lng, km, limit=None):
+        """
+        (property, distance in km) pairs for the properties
+        within km of (lat, lng), nearest first
+        """
+        from realestate import snapshot, geo  # both build on this module
+        current = snapshot.current()
+        rows, distances = geo.within(current, lat, lng, km)
+        ids = current.ids(rows[:limit])
+        properties = {realestate._id: realestate
+                      for realestate in cls.select().where(cls._id << ids)}
+        return [(properties[_id], distance)
+                for _id, distance in zip(ids, distances)
+                if _id in properties]
+
+    @property
     def nearby_properties(self):
-        pass
+        if self.lat is None or self.lng is None:
+            return []
+        return [(realestate, distance)
+                for realestate, distance in Realestate.within(self.lat, self.lng,
+                                                              NEARBY_DISTANCE,
+                                                              limit=NEARBY_LIMIT + 1)
+                if realestate._id != self._id][:NEARBY_LIMIT]
 
     @hybrid_property
     def appointment_proposals(self):
@@ -330,13 +646,22 @@ class Realestate(BaseModel):
     def next_queue_item(cls, user):
         return cls.full_queue(user).get()
 
+    @property
+    def reviewed_as(self):
+        """
+        The property whose reviews count for this one:
+        its canonical property if it's a duplicate listing
+        """
+        return self.canonical if self._data.get('canonical') else self
+
     @property
     def status(self):
-        if self.reviews.count() < User.select().count():
+        reviews = self.reviewed_as.reviews
+        if reviews.count() < User.select().count():
             return "pending"
-        if all(review.status == 'accepted' for review in self.reviews):
+        if all(review.status == 'accepted' for review in reviews):
             return "accepted"
-        if all(review.status == 'rejected' for review in self.reviews):
+        if all(review.status == 'rejected' for review in reviews):
             return "rejected"
         return "controversial"
 
@@ -346,7 +671,8 @@ class Realestate(BaseModel):
 
     @property
     def status_details(self):
-        return '\n'.join(review.user.username + ": " + review.status for review in self.reviews)
+        return '\n'.join(review.user.username + ": " + review.status
+                         for review in self.reviewed_as.reviews)
 
     @classmethod
     def reviewed(cls, user):
@@ -354,7 +680,9 @@ class Realestate(BaseModel):
 
     @classmethod
     def unreviewed_by(cls, user):
-        return cls.select().where(~(cls._id << cls.reviewed(user)) & ~cls.sold)
+        return cls.select().where(~(cls._id << cls.reviewed(user)) &
+                                  ~cls.sold &
+                                  cls.canonical.is_null())
 
     @hybrid_method
     def accepted_by(self, user):
@@ -399,10 +727,6 @@ class Realestate(BaseModel):
         except DoesNotExist:
             return None
 
-    @hybrid_property
-    def town(self):
-        return self.address.split()[-1]
-
     @property
     def thumbnail_pictures(self):
         return self._thumbnail_pictures.split(",")
@@ -515,6 +839,25 @@ class Realestate(BaseModel):
             return 0
         return self._score
 
+    def typed(self, short):
+        """
+        Like house.<short>, but returns the value as parsed at
+        ingestion (a number or an enum string) instead of the
+        raw text.
+        """
+        try:
+            information = (RealestateInformation
+                           .select(RealestateInformation.numeric_value,
+                                   RealestateInformation.enum_value)
+                           .join(RealestateInformationCategory)
+                           .where((RealestateInformation.realestate == self._id) &
+                                  (RealestateInformationCategory._short == short))
+                           .get())
+        except DoesNotExist:
+            return None
+        if information.enum_value is not None:
+            return information.enum_value
+        return information.numeric_value
 
     def __getattr__(self, short):
         """
@@ -538,8 +881,10 @@ class UserRealestateReview(BaseModel):
                                 ('unsure', 'Unsure'),
                                 ('accepted', 'Accepted')], null=True)
 
-    #class Meta:
-    #    primary_key = CompositeKey('user', 'realestate')
+    class Meta:
+        indexes = (
+            (('user', 'realestate'), True),
+        )
 
 
 @database.func()
@@ -565,6 +910,10 @@ class RealestateInformationCategory(BaseModel):
     applies_to_land = BooleanField(null=True)
     #  dependent_criteria = TextField()
 
+    value_type = CharField(choices=[(value_type, value_type.title())
+                                    for value_type in VALUE_TYPES],
+                           default='text')
+
     @property
     def short(self):
         return (self._short or
@@ -590,6 +939,30 @@ class RealestateInformationCategory(BaseModel):
     def realo_name(self, value):
         self._realo_name = value
 
+    def reparse(self):
+        """
+        Parse all values in this category again, e.g. after its value
+        type was changed. The parsed columns are written with plain
+        updates, so the scores aren't recomputed here (see
+        celery.reparse_information). Returns the ids of the properties.
+        """
+        realestate_ids = []
+        with database.atomic():
+            for information in (RealestateInformation
+                                .select()
+                                .where(RealestateInformation.category == self._id)):
+                information.category = self
+                information.parse()
+                (RealestateInformation
+                 .update(numeric_value=information.numeric_value,
+                         enum_value=information.enum_value,
+                         parse_error=information.parse_error)
+                 .where(RealestateInformation._id == information._id)
+                 .execute())
+                realestate_ids.append(information._data['realestate'])
+                database.after_commit(touch, information._data['realestate'])
+        return realestate_ids
+
     def __repr__(self):
         return "{}: {}".format(self.__class__.__name__, self.name)
 
@@ -599,10 +972,43 @@ class RealestateInformation(BaseModel):
     category = ForeignKeyField(RealestateInformationCategory)
     value = CharField(null=True)
 
+    numeric_value = FloatField(null=True, index=True)
+    enum_value = CharField(null=True, index=True)
+    parse_error = TextField(null=True)
+
+    class Meta:
+        indexes = (
+            (('realestate', 'category'), True),
+        )
+
     @hybrid_property
     def name(self):
         return self.category.name
 
+    def parse(self):
+        """
+        Parse value once, according to the value type of its
+        category, so criteria and queries don't have to.
+        Values that can't be parsed are kept (and flagged)
+        for review.
+        """
+        self.numeric_value = self.enum_value = self.parse_error = None
+        if not self.value:
+            return
+        try:
+            parsed = parse(self.category.value_type, self.value)
+        except ValueError as e:
+            self.parse_error = str(e)
+            return
+        if isinstance(parsed, str):
+            self.enum_value = parsed
+        else:
+            self.numeric_value = parsed
+
+    def save(self, *args, **kwargs):
+        self.parse()
+        return super().save(*args, **kwargs)
+
     def __repr__(self):
         return "{} information for property in {}: {}".format(self.category.name,
                                                            self.realestate.town,
@@ -637,6 +1043,11 @@ class RealestateCriterionScore(BaseModel):
     defaultscore = IntegerField(null=True)
     defaultcomment = TextField(null=True)
 
+    class Meta:
+        indexes = (
+            (('realestate', 'criterion'), True),
+        )
+
     def __getattr__(self, name):
         return getattr(self.criterion, name, None)
 
@@ -679,10 +1090,12 @@ class RealestateCriterionScore(BaseModel):
         if not self.builtin:
             return
         try:
-            self.defaultscore, self.defaultcomment = getattr(realestate.criteria_funcs, self.short)(self.realestate)
-            self.save()
+            defaults = getattr(realestate.criteria_funcs, self.short)(self.realestate)
         except AttributeError as e:
             return None
+        if defaults != (self.defaultscore, self.defaultcomment):  # saving marks the property as changed
+            self.defaultscore, self.defaultcomment = defaults
+            self.save()
 
     def __repr__(self):
         return "{} score for property in {}: {}".format(self.criterion.name,
@@ -690,9 +1103,12 @@ class RealestateCriterionScore(BaseModel):
                                                         self.score)
 
 
+APPOINTMENT_DURATION = timedelta(hours=1)
+
+
 class Appointment(BaseModel):
     realestate = ForeignKeyField(Realestate, related_name='appointments')
-    dt = DateTimeField()
+    dt = DateTimeField(index=True)
 
     class Meta:
         order_by = ('dt',)
@@ -703,13 +1119,14 @@ class Appointment(BaseModel):
 
 
 class CustomBase(BaseModel):
-    dt = DateTimeField(default=datetime.now())
+    dt = DateTimeField(default=datetime.now)
     body = TextField()
 
 
 class Message(CustomBase):
     author = ForeignKeyField(User, related_name='messages')
     realestate = ForeignKeyField(Realestate, related_name='messages')
+    edited = IntegerField(default=0)  # times edited, the version of the body
 
     @classmethod
     def create(cls, *args, **kwargs):
@@ -724,8 +1141,37 @@ class Message(CustomBase):
                         self.body,
                         self.readable_datetime()))
 
+    @classmethod
+    def thread(cls, realestate_id, cursor=None, per_page=20):
+        """
+        A page of the messages about a property, newest first, with
+        their authors, and the cursor for the next page (None if this
+        is the last one). Paginated like Notification.page_for.
+        """
+        query = (cls
+                 .select(cls, User)
+                 .join(User)
+                 .where(cls.realestate == realestate_id))
+        if cursor:
+            dt, _id = cursor
+            query = query.where((cls.dt < dt) | ((cls.dt == dt) & (cls._id < _id)))
+        messages = list(query
+                        .order_by(cls.dt.desc(), cls._id.desc())
+                        .limit(per_page + 1))
+        if len(messages) <= per_page:
+            return messages, None
+        last = messages[per_page - 1]
+        return messages[:per_page], (last.dt, last._id)
+
     class Meta:
         order_by = ('dt',)
+        indexes = (
+            (('realestate', 'dt'), False),
+        )
+
+
+NOTIFICATION_FANOUT_THRESHOLD = 20  # more recipients than this are notified by Celery
+NOTIFICATION_BATCH_SIZE = 100  # rows per INSERT, well within SQLite's variable limit
 
 
 class Notification(CustomBase):
@@ -747,42 +1193,277 @@ class Notification(CustomBase):
 
     @classmethod
     def create(cls, category, realestate, object_id=None):
-        for user in current_user.others():
-            print("User: " + user.username)
-            obj = cls()
-            obj.user = user._id
-            obj.realestate = realestate._id
-            obj.category = category
-            obj.object_id = object_id or realestate._id
-            try:
-                message_string = cls.MESSAGES[category]
-            except KeyError:
-                raise ValueError(
-                    """
-                    Invalid category; valid categories are {}.
-                    The one you entered is {}.
-                    """.format(", ".join(cls.MESSAGES.keys()), category))
-            obj.body = message_string.format(
-                    **{"town": realestate.town,
-                       "username": current_user.username})
-            obj.save()
-            obj.body = (
+        """
+        Notify everyone but the current user. Small groups are notified
+        right away; large ones are handed to a Celery task, so that
+        posting a message costs the same number of queries regardless.
+        """
+        if category not in cls.MESSAGES:
+            raise ValueError(
                 """
-                <a href="/notification/{}/">{}</a>
-                """).format(str(obj._id),
-                            obj.body)
-            obj.save()
+                Invalid category; valid categories are {}.
+                The one you entered is {}.
+                """.format(", ".join(cls.MESSAGES.keys()), category))
+        if current_user.others().count() > NOTIFICATION_FANOUT_THRESHOLD:
+            from realestate.celery import fan_out_notifications  # the tasks import this module
+            fan_out_notifications.delay(category, realestate._id, object_id, current_user._id)
+        else:
+            cls.fan_out(category, realestate, object_id, current_user)
+
+    @classmethod
+    def fan_out(cls, category, realestate, object_id, author):
+        body = cls.MESSAGES[category].format(town=realestate.town,
+                                             username=author.username)
+        dt = datetime.now()
+        rows = [{"user": user_id,
+                 "realestate": realestate._id,
+                 "category": category,
+                 "object_id": object_id or realestate._id,
+                 "body": body,
+                 "dt": dt}
+                for user_id, in author.others().select(User._id).tuples()]
+        with database.atomic():
+            for i in range(0, len(rows), NOTIFICATION_BATCH_SIZE):
+                cls.insert_many(rows[i:i + NOTIFICATION_BATCH_SIZE]).execute()
+        adjust_unread([row["user"] for row in rows], 1)
+        bump_counters(*["notifications:{}".format(row["user"]) for row in rows])
+        publish("notification", {"category": category, "body": body},
+                user_ids=[row["user"] for row in rows])
+
+    def mark_as_read(self):
+        updated = (Notification
+                   .update(read=True)
+                   .where((Notification._id == self._id) & ~Notification.read)
+                   .execute())
+        self.read = True
+        if updated != 1:
+            return  # already read, possibly by a concurrent request
+        adjust_unread([self._data['user']], -1)
+        bump_counters("notifications:{}".format(self._data['user']))
+
+    @classmethod
+    def page_for(cls, user, cursor=None, per_page=50):
+        """
+        A page of notifications, newest first, and the cursor for the
+        next page (None if this is the last one). Paginating on (dt, _id)
+        rather than with OFFSET keeps every page an index range scan.
+        """
+        query = cls.select().where(cls.user == user._id)
+        if cursor:
+            dt, _id = cursor
+            query = query.where((cls.dt < dt) | ((cls.dt == dt) & (cls._id < _id)))
+        notifications = list(query
+                             .order_by(cls.dt.desc(), cls._id.desc())
+                             .limit(per_page + 1))
+        if len(notifications) <= per_page:
+            return notifications, None
+        last = notifications[per_page - 1]
+        return notifications[:per_page], (last.dt, last._id)
 
     class Meta:
         order_by = ('-dt',)
+        indexes = (
+            (('user', 'read', 'dt'), False),  # unread counts
+            (('user', 'dt'), False),  # the notifications page
+        )
+
+
+class Town(BaseModel):
+    """
+    Aggregates per town, kept up to date one town at a
+    time as its properties and their reviews change.
+    """
+    name = CharField(unique=True)
+    postcode = CharField(null=True)
+    property_count = IntegerField(default=0)
+    median_price_per_m2 = IntegerField(null=True)
+    accepted_count = IntegerField(default=0)
+
+    class Meta:
+        order_by = ('name',)
+
+    def __repr__(self):
+        return self.name
+
+    @classmethod
+    def refresh(cls, name):
+        properties = list(Realestate
+                          .select(Realestate.postcode,
+                                  Realestate.price,
+                                  Realestate.total_area)
+                          .where((Realestate.town == name) & ~Realestate.sold)
+                          .tuples())
+        postcodes = [postcode for postcode, _, _ in properties if postcode]
+        prices_per_m2 = sorted(price / total_area
+                               for _, price, total_area in properties
+                               if price and total_area)
+        accepted_count = (Realestate
+                          .select(Realestate._id)
+                          .join(UserRealestateReview)
+                          .where((Realestate.town == name) &
+                                 ~Realestate.sold &
+                                 (UserRealestateReview.status == 'accepted'))
+                          .group_by(Realestate._id)
+                          .having(fn.COUNT(UserRealestateReview._id) ==
+                                  User.select().count())
+                          .count())
+
+        if not properties:
+            cls.delete().where(cls.name == name).execute()
+            return
+        town, _ = cls.get_or_create(name=name)
+        town.postcode = postcodes[0] if postcodes else None
+        town.property_count = len(properties)
+        town.median_price_per_m2 = (round(median(prices_per_m2))
+                                    if prices_per_m2 else None)
+        town.accepted_count = accepted_count
+        town.save()
+
+    @classmethod
+    def rebuild(cls):
+        names = {name for name, in (Realestate
+                                    .select(Realestate.town)
+                                    .distinct()
+                                    .tuples())}
+        names.update(town.name for town in cls.select())
+        with database.atomic():
+            for name in names:
+                if name is not None:
+                    cls.refresh(name)
 
 
 class UserAvailability(BaseModel):
     """
-    Book appointments only when all users are available
+    Book appointments only when all users are available.
+    From dt until end (an hour if there's no end), repeated every
+    week until the date until if weekly.
     """
     user = ForeignKeyField(User, related_name='available')
-    dt = DateTimeField()
+    dt = DateTimeField(index=True)
+    end = DateTimeField(null=True)
+    weekly = BooleanField(default=False)
+    until = DateField(null=True)
 
     class Meta:
         order_by = ('dt',)
+
+
+def realestate_changed(sender, instance, *args):
+    database.after_commit(touch, instance._id)
+
+
+def realestate_listed(sender, instance, created):
+    if created:
+        database.after_commit(touch_url, instance._id)
+
+
+def realestate_delisted(sender, instance, *args):
+    database.after_commit(touch_url, instance._id)
+
+
+def related_realestate_changed(sender, instance, *args):
+    database.after_commit(touch, instance._data['realestate'])
+
+
+def canonical_reviewed(sender, instance, *args):
+    for _id, in (Realestate
+                 .select(Realestate._id)
+                 .where(Realestate.canonical == instance._data['realestate'])
+                 .tuples()):
+        database.after_commit(touch, _id)  # their status is this one's
+
+
+def everything_changed(sender, instance, *args):
+    r.incr(GENERATION_KEY)
+
+
+def appointments_changed(sender, instance, *args):
+    bump_counters("appointment")
+
+
+def availability_changed(sender, instance, *args):
+    bump_counters("availability")
+
+post_save.connect(realestate_changed, sender=Realestate)
+post_delete.connect(realestate_changed, sender=Realestate)
+post_save.connect(realestate_listed, sender=Realestate)
+post_delete.connect(realestate_delisted, sender=Realestate)
+for model in (UserRealestateReview, RealestateCriterionScore):
+    post_save.connect(related_realestate_changed, sender=model)
+    post_delete.connect(related_realestate_changed, sender=model)
+post_save.connect(canonical_reviewed, sender=UserRealestateReview)
+post_delete.connect(canonical_reviewed, sender=UserRealestateReview)
+for model in (User, RealestateCriterion):
+    post_save.connect(everything_changed, sender=model)
+    post_delete.connect(everything_changed, sender=model)
+post_save.connect(appointments_changed, sender=Appointment)
+post_delete.connect(appointments_changed, sender=Appointment)
+post_save.connect(availability_changed, sender=UserAvailability)
+post_delete.connect(availability_changed, sender=UserAvailability)
+
+
+def realestate_recorded(sender, instance, created):
+    if created:
+        record('listing', instance, price=instance.price)
+
+
+def message_recorded(sender, instance, created):
+    if created:
+        record('message', instance.realestate, instance.author)
+
+
+def appointment_recorded(sender, instance, created):
+    if created:
+        record('appointment', instance.realestate, dt=instance.readable_datetime())
+
+post_save.connect(realestate_recorded, sender=Realestate)
+post_save.connect(message_recorded, sender=Message)
+post_save.connect(appointment_recorded, sender=Appointment)
+
+
+def realestate_moved(sender, instance, *args):
+    for town in {instance.town, instance.__dict__.get('_previous_town')}:
+        if town is not None:
+            Town.refresh(town)
+
+
+def review_changed(sender, instance, *args):
+    town, = (Realestate
+             .select(Realestate.town)
+             .where(Realestate._id == instance._data['realestate'])
+             .tuples()
+             .get())
+    if town is not None:
+        Town.refresh(town)
+
+
+def user_loaded(sender, instance):
+    instance._loaded_active = instance.active
+
+
+def user_saved(sender, instance, created):
+    """
+    The number of active users decides what counts as accepted, so
+    towns are rebuilt when it changes, not on every save of a user
+    """
+    if created or getattr(instance, '_loaded_active', None) != instance.active:
+        Town.rebuild()
+    instance._loaded_active = instance.active
+
+
+def user_deactivated(sender, instance, created):
+    if not instance.active:
+        bump_counters(ical_counter(instance._id))
+
+
+def user_deleted(sender, instance):
+    Town.rebuild()
+
+post_save.connect(realestate_moved, sender=Realestate)
+post_delete.connect(realestate_moved, sender=Realestate)
+post_save.connect(review_changed, sender=UserRealestateReview)
+post_delete.connect(review_changed, sender=UserRealestateReview)
+post_init.connect(user_loaded, sender=User)
+post_save.connect(user_saved, sender=User)
+post_save.connect(user_deactivated, sender=User)
+post_delete.connect(user_deleted, sender=User)
@@ -0,0 +1,80 @@
+import re
+
+"""
+Parsers for information values, by value type.
+
+A parser takes the raw string scraped from Realo (or typed in by a
+user) and returns either a number, which ends up in
+RealestateInformation.numeric_value, or a string, which ends up in
+RealestateInformation.enum_value. Parsers raise ValueError for
+values they can't make sense of.
+"""
+
+parsers = {}
+
+
+def parser(value_type):
+    def registrar(func):
+        parsers[value_type] = func
+        return func
+    return registrar
+
+
+def parse(value_type, value):
+    try:
+        func = parsers[value_type]
+    except KeyError:
+        raise ValueError("Unknown value type {}".format(value_type))
+    return func(value)
+
+
+def _first_number(value):
+    match = re.search("[0-9]+", value)
+    if match is None:
+        raise ValueError("No number in {!r}".format(value))
+    return int(match.group(0))
+
+
+@parser('text')
+def text(value):
+    return None  # free text is kept as is and not indexed
+
+
+@parser('enum')
+def enum(value):
+    return value.strip()
+
+
+@parser('integer')
+def integer(value):
+    return _first_number(value)
+
+
+@parser('year')
+def year(value):
+    value = _first_number(value)
+    if not 1000 <= value <= 2100:
+        raise ValueError("{} is not a plausible year".format(value))
+    return value
+
+
+@parser('money')
+def money(value):
+    """
+    Realo amounts look like "€1.234" (dots as thousands separators)
+    """
+    digits = re.sub("[^0-9]", "", value.split(",")[0])
+    if not digits:
+        raise ValueError("No amount in {!r}".format(value))
+    return int(digits)
+
+
+@parser('epc')
+def epc(value):
+    """
+    EPC values look like "312 kWh/m²"
+    """
+    return _first_number(value)
+
+
+VALUE_TYPES = sorted(parsers)
@@ -0,0 +1,141 @@
+import re
+from flask import Markup
+from flask import escape
+from realestate.models import database
+from realestate.models import Realestate
+from realestate.models import Message
+
+"""
+Full-text search, using SQLite FTS5 external content tables over
+realestate (address, description, seller) and message (body). The
+indexes only store the inverted index; the text itself stays in
+the original tables. Triggers keep them in sync, so every write
+path (the scraper, forms, the admin) is covered.
+"""
+
+PER_PAGE = 20
+
+# Unlikely to occur in listings, so they can be swapped for
+# <mark> tags after the snippet has been escaped.
+_START, _END = '\x02', '\x03'
+
+INDEXES = {
+    'realestate_search': (Realestate, ['address', 'description', 'seller']),
+    'message_search': (Message, ['body']),
+}
+
+# Matches in the address weigh more than in the seller,
+# which weigh more than in the description.
+PROPERTY_WEIGHTS = (10.0, 1.0, 5.0)
+
+
+def _ddl(index, model, columns):
+    table = model._meta.db_table
+    column_list = ', '.join(columns)
+    new_values = ', '.join('new.' + column for column in columns)
+    old_values = ', '.join('old.' + column for column in columns)
+    return [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5(
+               {column_list},
+               content='{table}',
+               content_rowid='_id',
+               tokenize='unicode61 remove_diacritics 1')""",
+        """CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {table} BEGIN
+               INSERT INTO {index}(rowid, {column_list}) VALUES (new._id, {new_values});
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {table} BEGIN
+               INSERT INTO {index}({index}, rowid, {column_list}) VALUES ('delete', old._id, {old_values});
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE OF {column_list} ON {table} BEGIN
+               INSERT INTO {index}({index}, rowid, {column_list}) VALUES ('delete', old._id, {old_values});
+               INSERT INTO {index}(rowid, {column_list}) VALUES (new._id, {new_values});
+           END""",
+    ], dict(index=index, table=table, column_list=column_list,
+            new_values=new_values, old_values=old_values)
+
+
+def create_indexes():
+    for index, (model, columns) in INDEXES.items():
+        statements, names = _ddl(index, model, columns)
+        for statement in statements:
+            database.execute_sql(statement.format(**names))
+
+
+def rebuild_indexes():
+    """
+    Reindex everything, e.g. for rows that were
+    written before the triggers existed.
+    """
+    for index in INDEXES:
+        database.execute_sql("INSERT INTO {0}({0}) VALUES ('rebuild')".format(index))
+
+
+def to_match_query(text):
+    """
+    Turn what the user typed into a safe FTS5 query: every word must
+    match, and the last one may be incomplete (search as you type).
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    terms = ['"{}"'.format(word) for word in words]
+    terms[-1] += ' *'
+    return ' '.join(terms)
+
+
+def _highlighted(text):
+    if text is None:
+        return None
+    return Markup(str(escape(text))
+                  .replace(_START, '<mark>')
+                  .replace(_END, '</mark>'))
+
+
+def _page(sql, params, page, per_page):
+    """
+    One page of results, plus whether there's another one
+    """
+    rows = database.execute_sql(sql + " LIMIT ? OFFSET ?",
+                                params + [per_page + 1, (page - 1) * per_page]).fetchall()
+    return rows[:per_page], len(rows) > per_page
+
+
+def search_properties(text, page=1, per_page=PER_PAGE):
+    query = to_match_query(text)
+    if query is None:
+        return [], False
+    rows, more = _page(
+        """SELECT rowid,
+                  highlight(realestate_search, 0, ?, ?),
+                  snippet(realestate_search, 1, ?, ?, '...', 24),
+                  highlight(realestate_search, 2, ?, ?)
+           FROM realestate_search
+           WHERE realestate_search MATCH ?
+           ORDER BY bm25(realestate_search, ?, ?, ?)""",
+        [_START, _END] * 3 + [query] + list(PROPERTY_WEIGHTS),
+        page, per_page)
+    return [{'_id': _id,
+             'address': _highlighted(address),
+             'description': _highlighted(description),
+             'seller': _highlighted(seller)}
+            for _id, address, description, seller in rows], more
+
+
+def search_messages(text, page=1, per_page=PER_PAGE):
+    query = to_match_query(text)
+    if query is None:
+        return [], False
+    rows, more = _page(
+        """SELECT message_search.rowid,
+                  message.realestate_id,
+                  snippet(message_search, 0, ?, ?, '...', 24)
+           FROM message_search
+           JOIN message ON message._id = message_search.rowid
+           WHERE message_search MATCH ?
+           ORDER BY rank""",
+        [_START, _END, query],
+        page, per_page)
+    return [{'_id': _id,
+             'realestate_id': realestate_id,
+             'body': _highlighted(body)}
+            for _id, realestate_id, body in rows], more
@@ -8,6 +8,7 @@ from realestate.models import RealestateInformationCategory
 from realestate.models import UserNotAvailableError
 from realestate.models import DoesNotExist
 from realestate.criteria_funcs import criteria_list
+from realestate import search
 
 
 @app.before_first_request
@@ -15,6 +16,7 @@ def setup_database():
     for cls in BaseModel.tables():
         #  cls.drop_table(fail_silently=True)
         cls.create_table(fail_silently=True)
+    search.create_indexes()
     try:
         User.get_or_create(username="Ben", password="randompass")
     except UserNotAvailableError:
@@ -45,16 +47,20 @@ def setup_builtin_criteria():
 @app.before_first_request
 def setup_information():
     INFORMATION = [
-        ("year", "Year", "Bouwjaar", ['house']),
-        ("cadastral_income", "Cadastral income", "Kadastraal Inkomen", ['house']),
-        ("spatial_planning", "Spatial planning", "Ruimtelijke ordening", ['house']),
-        ("epc", "EPC score", "EPC waarde", ['house']),
-        ("heating", "Heating", "Type verwarming", ['house']),
-        ("building", "Building", "Bebouwing", ['house'])]
-    for short, name, realo_name, applies_to in INFORMATION:
-        RealestateInformationCategory.get_or_create(
+        ("year", "Year", "Bouwjaar", 'year', ['house']),
+        ("cadastral_income", "Cadastral income", "Kadastraal Inkomen", 'money', ['house']),
+        ("spatial_planning", "Spatial planning", "Ruimtelijke ordening", 'enum', ['house']),
+        ("epc", "EPC score", "EPC waarde", 'epc', ['house']),
+        ("heating", "Heating", "Type verwarming", 'enum', ['house']),
+        ("building", "Building", "Bebouwing", 'enum', ['house'])]
+    for short, name, realo_name, value_type, applies_to in INFORMATION:
+        category, _ = RealestateInformationCategory.get_or_create(
                                        _short=short,
                                        _name=name,
                                        _realo_name=realo_name,
                                        applies_to_house='house' in applies_to,
                                        applies_to_land='land' in applies_to)
+        if category.value_type != value_type:
+            category.value_type = value_type
+            category.save()
+            category.reparse()
@@ -0,0 +1,363 @@
+import json
+import os
+import shutil
+import numpy as np
+from realestate.models import r
+from realestate.models import Realestate
+from realestate.models import RealestateFeature
+from realestate.models import Feature
+from realestate.models import ACCEPTED
+from realestate.models import CONTROVERSIAL
+from realestate.models import PENDING
+from realestate.models import REJECTED
+from realestate.models import changed_since
+from realestate.models import change_counters
+from realestate import geo
+from config import ROOT
+
+"""
+A columnar, read-only copy of the realestate table.
+
+Every column is a NumPy array stored as its own .npy file, so
+that all gunicorn workers can memory-map the same snapshot instead
+of each holding (and rebuilding) a private copy. Rows are sorted
+by _id. A new snapshot is written next to the old one and the
+CURRENT pointer is swapped atomically, so readers never see a
+half-written snapshot. A snapshot written in an older format (or
+that can't be read) is rebuilt from scratch. Web requests never wait
+for a stale snapshot to be refreshed: they serve it and leave the
+refresh to the cache workers.
+"""
+
+SNAPSHOT_DIR = os.path.join(ROOT, 'snapshot')
+POINTER = os.path.join(SNAPSHOT_DIR, 'CURRENT')
+LOCK_KEY = "realestate:snapshot:lock"
+QUEUED_KEY = "realestate:snapshot:queued"
+QUEUED_TTL = 60  # seconds; after that, a lost refresh task can be queued again
+
+REALESTATE_TYPES = ['house', 'land']
+STATUS_RANKS = {str(status).lower(): status.int_value
+                for status in (ACCEPTED, CONTROVERSIAL, PENDING, REJECTED)}
+
+COLUMNS = [
+    ('_id', np.int64),
+    ('price', np.float64),
+    ('inhabitable_area', np.float64),  # NaN for land
+    ('total_area', np.float64),
+    ('lat', np.float64),
+    ('lng', np.float64),
+    ('realestate_type', np.int8),  # index in REALESTATE_TYPES
+    ('sold', np.bool_),
+    ('visited', np.bool_),
+    ('score', np.int16),
+    ('raw_score', np.int16),  # score ignoring dealbreakers
+    ('status', np.int8),  # see STATUS_RANKS
+    ('town', np.int32),  # index in Snapshot.codes['town']
+    ('seller', np.int32),  # index in Snapshot.codes['seller']
+]
+CODED_COLUMNS = ['town', 'seller']
+COLUMN_NAMES = [name for name, _ in COLUMNS] + ['features']
+DERIVED_COLUMNS = ['cell_keys', 'by_cell']  # rebuilt on every write, see geo.py
+FORMAT = 2  # bump whenever the columns or meta.json change
+
+
+def _nullable(value):
+    return np.nan if value is None else value
+
+
+def _code(codes, column, value):
+    return codes[column].setdefault(value, len(codes[column]))
+
+
+def _row(realestate, codes):
+    return (realestate._id,
+            realestate.price,
+            _nullable(realestate.inhabitable_area),
+            realestate.total_area,
+            _nullable(realestate.lat),
+            _nullable(realestate.lng),
+            REALESTATE_TYPES.index(realestate.realestate_type),
+            realestate.sold,
+            realestate.visited,
+            realestate.score,
+            realestate._score,
+            STATUS_RANKS[realestate.status],
+            _code(codes, 'town', realestate.town),
+            _code(codes, 'seller', realestate.seller))
+
+
+def _to_columns(query, codes, features):
+    """
+    Columns for the properties in query. Features are stored as a
+    boolean matrix with one row per property and one column per
+    feature, which doubles as a bitmap index.
+    """
+    rows = [_row(realestate, codes) for realestate in query]
+    values = list(zip(*rows)) or [()] * len(COLUMNS)
+    columns = {name: np.array(column, dtype=dtype)
+               for (name, dtype), column in zip(COLUMNS, values)}
+
+    ids = [row[0] for row in rows]
+    matrix = np.zeros((len(ids), len(features)), dtype=np.bool_)
+    if ids:
+        pairs = (RealestateFeature
+                 .select(RealestateFeature.realestate, Feature.name)
+                 .join(Feature)
+                 .where(RealestateFeature.realestate << ids)
+                 .tuples())
+        positions = {_id: i for i, _id in enumerate(ids)}
+        for realestate_id, name in pairs:
+            if name not in features:
+                features[name] = len(features)
+                matrix = np.pad(matrix, ((0, 0), (0, 1)), 'constant')
+            matrix[positions[realestate_id], features[name]] = True
+    columns['features'] = matrix
+    return columns
+
+
+class Snapshot:
+    def __init__(self, name, columns, meta):
+        self.name = name
+        self.columns = columns
+        self.seq = meta['seq']
+        self.generation = meta['generation']
+        self.codes = meta['codes']
+        self.features = meta['features']
+
+    @classmethod
+    def load(cls, name):
+        path = os.path.join(SNAPSHOT_DIR, name)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('format') != FORMAT:
+            raise ValueError("snapshot {} has format {}, not {}".format(
+                name, meta.get('format'), FORMAT))
+        columns = {column: np.load(os.path.join(path, column + '.npy'),
+                                   mmap_mode='r')
+                   for column in COLUMN_NAMES + DERIVED_COLUMNS}
+        return cls(name, columns, meta)
+
+    def __len__(self):
+        return len(self.columns['_id'])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    @property
+    def stale(self):
+        return (self.seq, self.generation) != change_counters()
+
+    def positions(self, ids):
+        """
+        Row numbers of the given property ids; ids
+        that are not in the snapshot are dropped.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self):
+            return np.array([], dtype=np.int64)
+        positions = np.searchsorted(self['_id'], ids)
+        positions[positions == len(self)] = 0
+        return positions[self['_id'][positions] == ids]
+
+    def isin(self, ids):
+        mask = np.zeros(len(self), dtype=np.bool_)
+        mask[self.positions(ids)] = True
+        return mask
+
+    def mask(self, **conditions):
+        """
+        Vectorised filter. A (low, high) tuple is an inclusive range
+        (either bound may be None), a list means "any of these"
+        (values that don't exist match nothing) and anything else
+        is compared for equality:
+
+            snapshot.mask(price=(None, 300000), realestate_type=['house'])
+        """
+        mask = np.ones(len(self), dtype=np.bool_)
+        for column, condition in conditions.items():
+            values = self[column]
+            if column == 'realestate_type' and isinstance(condition, list):
+                condition = [REALESTATE_TYPES.index(c)
+                             for c in condition
+                             if c in REALESTATE_TYPES]
+            elif column == 'status' and isinstance(condition, list):
+                condition = [STATUS_RANKS[c] for c in condition if c in STATUS_RANKS]
+            elif column in CODED_COLUMNS and isinstance(condition, list):
+                condition = [self.codes[column].index(c)
+                             for c in condition
+                             if c in self.codes[column]]
+            elif column == 'features':
+                mask &= self.with_features(condition)
+                continue
+            if isinstance(condition, tuple):
+                low, high = condition
+                if low is not None:
+                    mask &= values >= low
+                if high is not None:
+                    mask &= values <= high
+            elif isinstance(condition, list):
+                mask &= np.in1d(values, condition)
+            else:
+                mask &= values == condition
+        return mask
+
+    def with_features(self, names):
+        """
+        Mask of the properties that have all of the given features
+        """
+        mask = np.ones(len(self), dtype=np.bool_)
+        for name in names:
+            if name not in self.features:
+                return np.zeros(len(self), dtype=np.bool_)
+            mask &= self['features'][:, self.features.index(name)]
+        return mask
+
+    def order(self, *columns, mask=None, reverse=True):
+        """
+        Row numbers sorted on the given columns, the first
+        column being the most significant one.
+        """
+        rows = np.arange(len(self)) if mask is None else np.flatnonzero(mask)
+        keys = [self[column][rows] for column in reversed(columns)]
+        order = rows[np.lexsort(keys)]
+        return order[::-1] if reverse else order
+
+    def top(self, column, k, mask=None):
+        """
+        Row numbers of the k rows with the highest value in column,
+        without sorting the whole catalogue.
+        """
+        rows = np.arange(len(self)) if mask is None else np.flatnonzero(mask)
+        values = self[column][rows]
+        if k < len(rows):
+            rows = rows[np.argpartition(-values, k)[:k]]
+            values = self[column][rows]
+        return rows[np.argsort(-values, kind='mergesort')]
+
+    def ids(self, rows):
+        return [int(_id) for _id in self['_id'][rows]]
+
+
+def _read_pointer():
+    try:
+        with open(POINTER) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _load(name):
+    """
+    The snapshot called name, or None if it's missing, unreadable or
+    in another format
+    """
+    if name is None:
+        return None
+    try:
+        return Snapshot.load(name)
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _write(columns, seq, generation, codes, features):
+    name = "{}-{}".format(generation, seq)
+    path = os.path.join(SNAPSHOT_DIR, name)
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    columns['cell_keys'], columns['by_cell'] = geo.index(columns['lat'], columns['lng'])
+    for column, values in columns.items():
+        np.save(os.path.join(tmp_path, column + '.npy'), values)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'format': FORMAT,
+                   'seq': seq,
+                   'generation': generation,
+                   'codes': {column: sorted(values, key=values.get)
+                             for column, values in codes.items()},
+                   'features': sorted(features, key=features.get)}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+    previous = _read_pointer()
+    with open(POINTER + '.tmp', 'w') as f:
+        f.write(name)
+    os.replace(POINTER + '.tmp', POINTER)
+    # The previous snapshot is kept for workers that have just read the
+    # old pointer. Older ones are removed; workers that still have them
+    # mapped keep their pages until they reopen.
+    for old in os.listdir(SNAPSHOT_DIR):
+        if old not in (name, previous, 'CURRENT'):
+            shutil.rmtree(os.path.join(SNAPSHOT_DIR, old), ignore_errors=True)
+    return Snapshot.load(name)
+
+
+def refresh(full=False, blocking=True):
+    """
+    Bring the snapshot up to date. Only properties changed since the
+    current snapshot are reloaded, unless the generation moved on
+    (or full is set), in which case the snapshot is rebuilt.
+    Returns None if blocking is False and another worker is busy.
+    """
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    lock = r.lock(LOCK_KEY, timeout=600)
+    if not lock.acquire(blocking=blocking):
+        return None
+    try:
+        r.delete(QUEUED_KEY)  # changes from now on need another refresh
+        seq, generation = change_counters()
+        snapshot = _load(_read_pointer())
+
+        if full or snapshot is None or snapshot.generation != generation:
+            codes = {column: {} for column in CODED_COLUMNS}
+            features = {}
+            columns = _to_columns(Realestate.select(), codes, features)
+        elif snapshot.seq >= seq:
+            return snapshot
+        else:
+            changed = changed_since(snapshot.seq)
+            codes = {column: {value: i for i, value in enumerate(values)}
+                     for column, values in snapshot.codes.items()}
+            features = {name: i for i, name in enumerate(snapshot.features)}
+            fresh = _to_columns(Realestate.select().where(Realestate._id << changed),
+                                codes, features)
+            old = dict(snapshot.columns)
+            old['features'] = np.pad(old['features'],
+                                     ((0, 0), (0, len(features) - len(snapshot.features))),
+                                     'constant')
+            keep = ~snapshot.isin(changed)  # deleted properties simply drop out
+            columns = {column: np.concatenate([old[column][keep], fresh[column]])
+                       for column in COLUMN_NAMES}
+            order = np.argsort(columns['_id'], kind='mergesort')
+            columns = {column: values[order] for column, values in columns.items()}
+
+        return _write(columns, seq, generation, codes, features)
+    finally:
+        lock.release()
+
+
+_current = None
+
+
+def queue_refresh():
+    """
+    Have a cache worker refresh the snapshot, unless a refresh is
+    queued already
+    """
+    if r.set(QUEUED_KEY, 1, nx=True, ex=QUEUED_TTL):
+        from realestate.celery import refresh_snapshot  # the tasks import this module
+        refresh_snapshot.delay()
+
+
+def current():
+    """
+    The snapshot for this process. A stale snapshot is served as it
+    is, and a refresh is queued; it's only built here if there's no
+    snapshot at all.
+    """
+    global _current
+    name = _read_pointer()
+    if _current is None or _current.name != name:
+        _current = _load(name) or refresh()
+    if _current.stale:
+        queue_refresh()
+    return _current
@@ -0,0 +1,99 @@
+import json
+from realestate.models import r
+from realestate.models import URL_CHANGED_KEY
+from realestate.models import Realestate
+from realestate.models import url_counter
+from realestate.models import epoch
+from realestate.utils import BloomFilter
+
+"""
+URL sync for the scraper.
+
+A cursor is "<epoch>:urls:<seq>", a position in the URL change log,
+which only moves when a property is added, marked as sold or deleted
+(see models.touch_url). Given its last cursor, the scraper gets the
+properties that changed since as JSON lines, ending
+with the next cursor. Without a valid cursor, e.g. on the first run or
+after Redis lost the change log, it gets a "reset" line and then
+every property.
+
+Instead of a first full sync, the scraper can download a Bloom
+filter of all URLs, along with the cursor it is valid for. It's only
+rebuilt when that cursor moves.
+"""
+
+BATCH_SIZE = 500
+BLOOM_KEY = "realestate:urls:bloom"
+BLOOM_ERROR_RATE = 0.001
+
+
+def make_cursor(seq):
+    return "{}:urls:{}".format(epoch(), seq)
+
+
+def parse_cursor(cursor):
+    """
+    The sequence number in cursor, or None if it's
+    missing, malformed or from another epoch
+    """
+    try:
+        cursor_epoch, log, seq = cursor.split(':')
+        seq = int(seq)
+    except (AttributeError, ValueError):
+        return None
+    if cursor_epoch != epoch() or log != 'urls':
+        return None
+    return seq
+
+
+def _line(data):
+    return json.dumps(data) + "\n"
+
+
+def _urls(query):
+    query = query.select(Realestate._id, Realestate.realo_url, Realestate.sold).tuples()
+    for _id, url, sold in query.iterator():
+        yield _id, {"_id": _id, "url": url, "sold": sold}
+
+
+def changes(cursor=None):
+    """
+    JSON lines: the properties changed since cursor, then {"cursor": ...}
+    """
+    seq = url_counter()  # read first: later changes go in the next sync
+    since = parse_cursor(cursor)
+    if since is None or since > seq:
+        yield _line({"reset": True})
+        for _, line in _urls(Realestate.select()):
+            yield _line(line)
+    else:
+        changed = [int(_id) for _id in r.zrangebyscore(URL_CHANGED_KEY, since + 1, seq)]
+        for start in range(0, len(changed), BATCH_SIZE):
+            batch = changed[start:start + BATCH_SIZE]
+            found = dict(_urls(Realestate.select().where(Realestate._id << batch)))
+            for _id in batch:
+                yield _line(found.get(_id, {"_id": _id, "deleted": True}))
+    yield _line({"cursor": make_cursor(seq)})
+
+
+def bloom_filter():
+    """
+    A Bloom filter of all URLs and the cursor it is up to date
+    with. It's rebuilt (from one column) when URLs were added or
+    removed, and shared between workers through Redis.
+    """
+    cursor = make_cursor(url_counter())
+    cached_cursor, bits, hashes, data = r.hmget(BLOOM_KEY, 'cursor', 'bits', 'hashes', 'data')
+    if cached_cursor is not None and cached_cursor.decode() == cursor:
+        return BloomFilter(int(bits), int(hashes), data), cursor
+
+    urls = Realestate.select(Realestate.realo_url).where(Realestate.realo_url.is_null(False))
+    # room for the URLs the scraper adds itself until it downloads a new one
+    bloom = BloomFilter.for_capacity(2 * urls.count(), BLOOM_ERROR_RATE)
+    for url, in urls.tuples().iterator():
+        bloom.add(url)
+    r.hmset(BLOOM_KEY, {'cursor': cursor,
+                        'bits': bloom.bits,
+                        'hashes': bloom.hashes,
+                        'data': bloom.to_bytes()})
+    return bloom, cursor
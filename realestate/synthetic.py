@@ -0,0 +1,251 @@
+import json
+import os
+import random
+import shutil
+import tempfile
+import zlib
+from contextlib import contextmanager
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+import redis
+from realestate import app
+from realestate import create_app
+from realestate import criteria_funcs
+from realestate import snapshot
+from realestate.celery import celery
+from realestate.celery import _add_from_json
+from realestate.models import database
+from realestate.models import r
+from realestate.models import cache
+from realestate.models import GENERATION_KEY
+from realestate.models import User
+from realestate.models import Realestate
+from realestate.models import RealestateCriterion
+from realestate.models import UserRealestateReview
+from realestate.models import Message
+from realestate.setup import setup_database
+from realestate.setup import setup_builtin_criteria
+from realestate.setup import setup_information
+from realestate.utils import camel_to_snake
+
+"""
+Deterministic synthetic data, for benchmarks and load tests.
+
+environment() points the app at a temporary SQLite database and
+snapshot directory, an in-memory Redis (fakeredis), eager Celery and
+an offline stand-in for the Google Maps travel times. generate()
+then fills it: the same seed always gives the same users, criteria,
+properties (ingested through the scraper's code path), information,
+reviews and messages.
+"""
+
+PASSWORD = "Synthetic1"
+BASE_DATE = date(2016, 1, 1)
+
+# name, postcode, lat, lng
+TOWNS = [
+    ("Leuven", "3000", 50.8798, 4.7005),
+    ("Heverlee", "3001", 50.8639, 4.6947),
+    ("Kessel-Lo", "3010", 50.8891, 4.7277),
+    ("Herent", "3020", 50.9084, 4.6713),
+    ("Bertem", "3060", 50.8633, 4.6275),
+    ("Kortenberg", "3070", 50.8899, 4.5408),
+    ("Tervuren", "3080", 50.8236, 4.5140),
+    ("Haacht", "3150", 50.9771, 4.6384),
+    ("Aarschot", "3200", 50.9853, 4.8372),
+    ("Tienen", "3300", 50.8073, 4.9378),
+    ("Oud-Heverlee", "3050", 50.8371, 4.6628),
+    ("Rotselaar", "3110", 50.9531, 4.7147),
+]
+STREETS = ["Kerkstraat", "Stationsstraat", "Dorpsstraat", "Molenstraat",
+           "Nieuwstraat", "Schoolstraat", "Kapelstraat", "Veldstraat",
+           "Bergstraat", "Beekstraat", "Lindelaan", "Kasteelstraat"]
+SELLERS = ["Immo Leuven", "Century 21", "ERA", "Trevi", "Dewaele",
+           "Immo Vlan", "Notaris Peeters", "Private seller"]
+FEATURES = ["garden", "garage", "terrace", "cellar", "attic",
+            "solar panels", "swimming pool", "fireplace"]
+HEATING = ["Gas", "Stookolie", "Elektrisch", "Warmtepomp"]
+BUILDING = ["Open", "Halfopen", "Gesloten"]
+SPATIAL_PLANNING = ["Woongebied", "Woongebied met landelijk karakter",
+                    "Recreatiegebied", "Agrarisch gebied"]
+WORDS = ["ruime", "lichtrijke", "gerenoveerde", "rustig", "gelegen",
+         "woning", "tuin", "keuken", "slaapkamers", "badkamer", "garage",
+         "zolder", "centrum", "nabij", "scholen", "winkels", "open",
+         "bebouwing", "zuidgerichte", "bouwgrond", "perceel", "ideaal"]
+
+
+def _travel_time(origin, destination):
+    """
+    Offline stand-in for utils.travel_time: a stable duration
+    between half an hour and two hours for every origin
+    """
+    seconds = 1800 + zlib.crc32((origin + destination).encode()) % 5400
+    return seconds, "{} mins".format(seconds // 60)
+
+
+@contextmanager
+def environment(root=None):
+    """
+    Run the app against throwaway storage. Everything that is
+    swapped out is restored on exit.
+    """
+    create_app()
+    root = root or tempfile.mkdtemp(prefix='realestate-')
+    os.makedirs(root, exist_ok=True)
+    import fakeredis  # only needed here, see requirements.txt
+
+    if not database.is_closed():
+        database.close()
+    saved = {'database': database.database,
+             'r': r.connection_pool,
+             'cache': cache.connection_pool,
+             'snapshot': (snapshot.SNAPSHOT_DIR, snapshot.POINTER, snapshot._current),
+             'eager': (celery.conf.CELERY_ALWAYS_EAGER,
+                       celery.conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS),
+             'travel_time': criteria_funcs.travel_time,
+             'config': dict(app.config)}
+
+    database.init(os.path.join(root, 'houses.db'))
+    pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection,
+                                server=fakeredis.FakeServer())
+    r.connection_pool = cache.connection_pool = pool
+    snapshot.SNAPSHOT_DIR = os.path.join(root, 'snapshot')
+    snapshot.POINTER = os.path.join(snapshot.SNAPSHOT_DIR, 'CURRENT')
+    snapshot._current = None
+    celery.conf.CELERY_ALWAYS_EAGER = True
+    celery.conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
+    criteria_funcs.travel_time = _travel_time
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    try:
+        yield root
+    finally:
+        if not database.is_closed():
+            database.close()
+        database.init(saved['database'])
+        r.connection_pool = saved['r']
+        cache.connection_pool = saved['cache']
+        snapshot.SNAPSHOT_DIR, snapshot.POINTER, snapshot._current = saved['snapshot']
+        (celery.conf.CELERY_ALWAYS_EAGER,
+         celery.conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS) = saved['eager']
+        criteria_funcs.travel_time = saved['travel_time']
+        app.config.clear()
+        app.config.update(saved['config'])
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def _sentence(rng, length):
+    return ' '.join(rng.choice(WORDS) for _ in range(length)).capitalize() + '.'
+
+
+def _information(rng):
+    """
+    Information as scraped from Realo, including the odd
+    value that can't be parsed
+    """
+    information = [
+        ("Bouwjaar", str(rng.randint(1890, 2016))),
+        ("Kadastraal Inkomen", "€{:,}".format(rng.randint(300, 2500)).replace(',', '.')),
+        ("EPC waarde", "{} kWh/m²".format(rng.randint(60, 700))),
+        ("Type verwarming", rng.choice(HEATING)),
+        ("Bebouwing", rng.choice(BUILDING)),
+        ("Ruimtelijke ordening", rng.choice(SPATIAL_PLANNING)),
+    ]
+    if rng.random() < 0.05:
+        information[0] = ("Bouwjaar", "onbekend")
+    rng.shuffle(information)
+    return information[:rng.randint(3, len(information))]
+
+
+def listing(rng, i):
+    """
+    A listing in the format the scraper posts to /post_new_realestate/
+    """
+    town, postcode, lat, lng = rng.choice(TOWNS)
+    realestate_type = 'house' if rng.random() < 0.8 else 'land'
+    total_area = rng.randint(150, 3000)
+    if realestate_type == 'house':
+        inhabitable_area = rng.randint(80, 350)
+        price = rng.randrange(150000, 600000, 1000)
+        information = _information(rng)
+    else:
+        inhabitable_area = None
+        price = rng.randrange(40000, 250000, 1000)
+        information = [("Ruimtelijke ordening", rng.choice(SPATIAL_PLANNING))]
+    pictures = ["https://picture.realo.be/synthetic/{}/{}.jpg".format(i, n)
+                for n in range(rng.randint(1, 6))]
+    return {
+        "added_on": (BASE_DATE + timedelta(days=rng.randint(0, 365))).isoformat(),
+        "realestate_type": realestate_type,
+        "seller": rng.choice(SELLERS),
+        "address": "{} {}, {} {}".format(rng.choice(STREETS), rng.randint(1, 200),
+                                         postcode, town),
+        "area": [inhabitable_area, total_area],
+        "coordinates": [lat + rng.gauss(0, 0.02), lng + rng.gauss(0, 0.03)],
+        "description": _sentence(rng, rng.randint(10, 40)),
+        "price": price,
+        "realo_url": "https://www.realo.be/nl/synthetic/{}".format(i),
+        "thumbnail_pictures": pictures,
+        "main_pictures": pictures,
+        "information": information,
+        "features": rng.sample(FEATURES, rng.randint(0, 4)),
+    }
+
+
+def form_name(form_class):
+    """
+    The value of the hidden formname field of a BaseForm,
+    which is how views tell their forms apart
+    """
+    return camel_to_snake(form_class.__name__.lower())
+
+
+def generate(properties=100, users=5, criteria=3, seed=0,
+             reviewed=0.5, messages=0.2):
+    """
+    Fill the database. Every user reviews a `reviewed` fraction of
+    the properties, and about `messages` messages are posted per
+    property. Returns the usernames; they all have PASSWORD.
+    """
+    rng = random.Random(seed)
+    setup_database()
+    setup_builtin_criteria()
+    setup_information()
+
+    usernames = ["user{}".format(n) for n in range(users)]
+    for username in usernames:
+        User.create(username=username, password=PASSWORD)
+    user_ids = [_id for _id, in User.select(User._id).tuples()]
+
+    for n in range(criteria):
+        RealestateCriterion.create(short="synthetic_{}".format(n),
+                                   name="Synthetic {}".format(n),
+                                   dealbreaker=rng.random() < 0.2,
+                                   importance=rng.randint(1, 10),
+                                   applies_to_house=True,
+                                   applies_to_land=rng.random() < 0.5)
+
+    for i in range(properties):
+        _add_from_json(json.dumps(listing(rng, i)))
+    realestate_ids = [_id for _id, in Realestate.select(Realestate._id).tuples()]
+
+    statuses = ['accepted', 'rejected', 'unsure']
+    reviews = [{'user': user_id,
+                'realestate': realestate_id,
+                'status': rng.choice(statuses),
+                'dt': datetime(2016, 1, 1) + timedelta(minutes=rng.randint(0, 525600))}
+               for user_id in user_ids
+               for realestate_id in realestate_ids
+               if rng.random() < reviewed]
+    posts = [{'author': rng.choice(user_ids),
+              'realestate': rng.choice(realestate_ids),
+              'body': _sentence(rng, rng.randint(3, 30)),
+              'dt': datetime(2016, 1, 1) + timedelta(minutes=rng.randint(0, 525600))}
+             for _ in range(int(properties * messages))]
+    with database.atomic():
+        for model, rows in ((UserRealestateReview, reviews), (Message, posts)):
+            for start in range(0, len(rows), 100):
+                model.insert_many(rows[start:start + 100]).execute()
+    r.incr(GENERATION_KEY)  # the bulk inserts bypass the signals
+    snapshot.refresh(full=True)
+    return usernames
@@ -0,0 +1,378 @@
+import json
+import random
+import threading
+import unittest
+from datetime import date
+from datetime import datetime
+import numpy as np
+from realestate import app
+from realestate import snapshot
+from realestate import parsers
+from realestate.facets import FacetedQuery
+from realestate import geo
+from realestate import synthetic
+from realestate import availability
+from realestate import ical
+from realestate import duplicates
+from realestate import fragments
+from realestate import activity
+from realestate.instrumentation import fingerprint
+from realestate.utils import parse_address
+from realestate.utils import BloomFilter
+from realestate.models import database
+from realestate.models import r
+from realestate.models import Realestate
+from realestate.models import UserAvailability
+
+"""
+Unit tests. Most cover the pure parts of the app; the ones that
+need a database and Redis run in synthetic.environment().
+
+    python -m unittest realestate.tests
+"""
+
+
+def _snapshot(ids, codes=None, feature_names=None, **columns):
+    columns['_id'] = np.array(ids, dtype=np.int64)
+    return snapshot.Snapshot('test', columns, {'seq': 0,
+                                               'generation': 0,
+                                               'codes': codes or {},
+                                               'features': feature_names or []})
+
+
+class SnapshotPositionsTest(unittest.TestCase):
+    def test_empty_snapshot(self):
+        empty = _snapshot([])
+        self.assertEqual(list(empty.positions([1, 2])), [])
+        self.assertEqual(len(empty.isin([1, 2])), 0)
+
+    def test_missing_ids_are_dropped(self):
+        current = _snapshot([2, 4, 6])
+        self.assertEqual(list(current.positions([6, 3, 2, 7])), [2, 0])
+        self.assertEqual(list(current.isin([4, 5])), [False, True, False])
+
+
+class SnapshotMaskTest(unittest.TestCase):
+    def setUp(self):
+        self.current = _snapshot([1, 2, 3],
+                                 realestate_type=np.array([0, 1, 0], dtype=np.int8),
+                                 status=np.array([4, 1, 2], dtype=np.int8))
+
+    def test_known_values(self):
+        self.assertEqual(list(self.current.mask(realestate_type=['house'],
+                                                status=['accepted', 'pending'])),
+                         [True, False, True])
+
+    def test_unknown_values_match_nothing(self):
+        self.assertEqual(list(self.current.mask(realestate_type=['castle'])),
+                         [False, False, False])
+        self.assertEqual(list(self.current.mask(status=['accepted', 'maybe'])),
+                         [True, False, False])
+
+
+class FacetCountsTest(unittest.TestCase):
+    def setUp(self):
+        ranks = snapshot.STATUS_RANKS
+        self.current = _snapshot(
+            [1, 2, 3, 4],
+            codes={'town': ['Leuven', 'Heverlee'], 'seller': ['ERA', 'Trevi']},
+            feature_names=['garden', 'garage'],
+            price=np.array([120000, 180000, 260000, np.nan]),
+            total_area=np.array([300, 800, 1500, 400], dtype=np.float64),
+            realestate_type=np.array([0, 0, 1, 0], dtype=np.int8),
+            town=np.array([0, 1, 0, 0], dtype=np.int32),
+            seller=np.array([0, 0, 1, 1], dtype=np.int32),
+            status=np.array([ranks['accepted'], ranks['rejected'],
+                             ranks['accepted'], ranks['pending']], dtype=np.int8),
+            score=np.array([60, 50, 70, 90], dtype=np.int16),
+            features=np.array([[True, False], [True, True],
+                               [False, False], [False, True]]),
+            sold=np.array([False, False, False, True]),
+            visited=np.array([True, False, False, False]))
+
+    def test_counts(self):
+        # Leuven houses: the first and the last property
+        counts = FacetedQuery(self.current, towns=['Leuven'], categories=['house']).counts()
+        self.assertEqual(counts['town'], {'Leuven': 2, 'Heverlee': 1})  # ignores the town
+        self.assertEqual(counts['category'], {'house': 2, 'land': 1})  # ignores the category
+        self.assertEqual(counts['status'], {'accepted': 1, 'pending': 1})
+        self.assertEqual(counts['seller'], {'ERA': 1, 'Trevi': 1})
+        self.assertEqual(counts['features'], {'garden': 1, 'garage': 1})
+        self.assertEqual(counts['sold'], {'yes': 1, 'no': 1})
+        self.assertEqual(counts['price']['100,000-150,000'], 1)
+        self.assertEqual(sum(counts['price'].values()), 1)  # no price, no bucket
+        self.assertEqual(counts['area']['250-500'], 2)
+
+    def test_rows(self):
+        rows = FacetedQuery(self.current, towns=['Leuven'], categories=['house']).rows()
+        self.assertEqual(list(rows), [0, 3])  # accepted before pending
+
+
+class ParsersTest(unittest.TestCase):
+    def test_values(self):
+        self.assertEqual(parsers.parse('year', "1975"), 1975)
+        self.assertEqual(parsers.parse('integer', "3 slaapkamers"), 3)
+        self.assertEqual(parsers.parse('money', "€1.234"), 1234)
+        self.assertEqual(parsers.parse('money', "€ 250.000,50"), 250000)
+        self.assertEqual(parsers.parse('epc', "312 kWh/m²"), 312)
+        self.assertEqual(parsers.parse('enum', "  Gas "), "Gas")
+        self.assertIsNone(parsers.parse('text', "Rustig gelegen"))
+
+    def test_unparseable_values(self):
+        for value_type, value in [('year', "onbekend"), ('year', "3000"),
+                                  ('integer', "geen"), ('money', "n.v.t."),
+                                  ('colour', "red")]:
+            with self.assertRaises(ValueError):
+                parsers.parse(value_type, value)
+
+
+class ParseAddressTest(unittest.TestCase):
+    def test_postcode_and_town(self):
+        self.assertEqual(parse_address("Kerkstraat 1, 3000 Leuven"), ("3000", "Leuven"))
+        self.assertEqual(parse_address("Dorpsstraat 12, 3390 Sint-Joris-Winge "),
+                         ("3390", "Sint-Joris-Winge"))
+
+    def test_without_postcode(self):
+        self.assertEqual(parse_address("Kerkstraat 1 Leuven"), (None, "Leuven"))
+        self.assertEqual(parse_address(""), (None, None))
+
+
+class GeoTest(unittest.TestCase):
+    def setUp(self):
+        # Brussels, Leuven, Antwerp and just outside Leuven
+        self.lats = np.array([50.8503, 50.8798, 51.2194, 50.90])
+        self.lngs = np.array([4.3517, 4.7005, 4.4025, 4.72])
+        cell_keys, by_cell = geo.index(self.lats, self.lngs)
+        self.snapshot = {'lat': self.lats, 'lng': self.lngs,
+                         'cell_keys': cell_keys, 'by_cell': by_cell}
+
+    def test_cells(self):
+        keys = geo.cells([50.88, 50.89, np.nan, 50.88], [4.72, 4.73, 4.72, np.nan])
+        self.assertEqual(keys[0], keys[1])
+        self.assertEqual(list(keys[2:]), [-1, -1])
+
+    def test_haversine(self):
+        distances = geo.haversine(50.8798, 4.7005, self.lats[:2], self.lngs[:2])
+        self.assertAlmostEqual(distances[0], 24.7, places=1)
+        self.assertAlmostEqual(distances[1], 0)
+
+    def test_within(self):
+        rows, distances = geo.within(self.snapshot, 50.8798, 4.7005, 5)
+        self.assertEqual(list(rows), [1, 3])
+        rows, distances = geo.within(self.snapshot, 50.8798, 4.7005, 30)
+        self.assertEqual(list(rows), [1, 3, 0])
+        self.assertEqual(list(distances), sorted(distances))
+
+    def test_within_mask(self):
+        mask = np.array([True, False, True, True])
+        rows, _ = geo.within(self.snapshot, 50.8798, 4.7005, 30, mask=mask)
+        self.assertEqual(list(rows), [3, 0])
+
+
+class SyntheticListingTest(unittest.TestCase):
+    def test_same_seed_same_listing(self):
+        self.assertEqual(synthetic.listing(random.Random(1), 7),
+                         synthetic.listing(random.Random(1), 7))
+        self.assertNotEqual(synthetic.listing(random.Random(1), 7),
+                            synthetic.listing(random.Random(2), 7))
+
+    def test_listings_parse(self):
+        rng = random.Random(0)
+        towns = {(postcode, town) for town, postcode, _, _ in synthetic.TOWNS}
+        for i in range(50):
+            listing = synthetic.listing(rng, i)
+            self.assertIn(parse_address(listing["address"]), towns)
+            self.assertTrue(listing["realo_url"].endswith("/{}".format(i)))
+
+
+class BloomFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.urls = ["https://www.realo.be/nl/{}".format(i) for i in range(1000)]
+        self.bloom = BloomFilter.for_capacity(len(self.urls), error_rate=0.01)
+        for url in self.urls:
+            self.bloom.add(url)
+
+    def test_no_false_negatives(self):
+        self.assertTrue(all(url in self.bloom for url in self.urls))
+
+    def test_false_positive_rate(self):
+        others = ["https://www.realo.be/fr/{}".format(i) for i in range(10000)]
+        self.assertLess(sum(url in self.bloom for url in others), 200)
+
+    def test_round_trip(self):
+        copy = BloomFilter(self.bloom.bits, self.bloom.hashes, self.bloom.to_bytes())
+        self.assertTrue(all(url in copy for url in self.urls))
+        self.assertEqual(copy.to_bytes(), self.bloom.to_bytes())
+
+
+class AvailabilityTest(unittest.TestCase):
+    def test_expand_once(self):
+        once = UserAvailability(dt=datetime(2016, 1, 4, 10), end=datetime(2016, 1, 4, 12))
+        self.assertEqual(list(availability.expand(once, datetime(2016, 1, 4, 11),
+                                                  datetime(2016, 2, 1))),
+                         [(datetime(2016, 1, 4, 11), datetime(2016, 1, 4, 12))])
+
+    def test_expand_weekly(self):
+        weekly = UserAvailability(dt=datetime(2016, 1, 4, 10), weekly=True,
+                                  until=date(2016, 1, 20))
+        self.assertEqual(list(availability.expand(weekly, datetime(2016, 1, 10),
+                                                  datetime(2016, 2, 1))),
+                         [(datetime(2016, 1, 11, 10), datetime(2016, 1, 11, 11)),
+                          (datetime(2016, 1, 18, 10), datetime(2016, 1, 18, 11))])
+
+    def test_merge(self):
+        self.assertEqual(availability.merge([(3, 5), (1, 2), (2, 4), (7, 8)]),
+                         [(1, 5), (7, 8)])
+
+    def test_common(self):
+        free = [[(0, 10)], [(2, 12)]]
+        self.assertEqual(list(availability.common(free, [(4, 5)], 2)), [(2, 4), (5, 10)])
+        self.assertEqual(list(availability.common(free, [(4, 5)], 3)), [(5, 10)])
+
+    def test_touching_intervals_dont_overlap(self):
+        self.assertEqual(list(availability.common([[(0, 4)], [(4, 8)]], [], 0)), [])
+
+
+class ICalTest(unittest.TestCase):
+    def test_escape(self):
+        self.assertEqual(ical._escape("a;b,c\\d\ne"), "a\\;b\\,c\\\\d\\ne")
+
+    def test_fold(self):
+        self.assertEqual(ical._fold("SUMMARY:Visit"), "SUMMARY:Visit")
+        for line in ["LOCATION:" + "x" * 100, "SUMMARY:" + "é" * 60]:
+            folded = ical._fold(line)
+            self.assertTrue(all(len(part.encode()) <= 75 for part in folded.split("\r\n")))
+            self.assertEqual(folded.replace("\r\n ", ""), line)
+
+    def test_render(self):
+        body = ical.render([(1, datetime(2016, 1, 4, 10), "Kerkstraat 1, 3000 Leuven", "Leuven")],
+                           now=datetime(2016, 1, 1))
+        self.assertIn("\r\nDTSTART:20160104T100000\r\nDTEND:20160104T110000\r\n", body)
+        self.assertIn("\r\nLOCATION:Kerkstraat 1\\, 3000 Leuven\r\n", body)
+        self.assertTrue(body.endswith("END:VEVENT\r\nEND:VCALENDAR\r\n"))
+
+
+DESCRIPTION = ("Ruime lichtrijke gerenoveerde woning rustig gelegen in een doodlopende "
+               "straat met tuin en garage vlakbij het centrum")
+
+
+class DuplicatesTest(unittest.TestCase):
+    def _signature(self, address, description):
+        return duplicates.signature(duplicates.shingles(
+            Realestate(address=address, description=description)))
+
+    def test_shingles(self):
+        self.assertEqual(duplicates.shingles(Realestate(address="Kerkstraat 1, Leuven")),
+                         {"kerkstraat 1", "1 leuven"})
+        self.assertEqual(duplicates.shingles(Realestate(address="Leuven", description="")),
+                         {"leuven"})
+
+    def test_similarity(self):
+        listing = self._signature("Kerkstraat 1, 3000 Leuven", DESCRIPTION)
+        relisted = self._signature("Kerkstraat 1, 3000 Leuven",
+                                   DESCRIPTION.replace("tuin", "terras"))
+        other = self._signature("Stationsstraat 80, 3300 Tienen",
+                                "Bouwgrond voor open bebouwing in woongebied")
+        self.assertEqual(duplicates.similarity(listing, listing), 1)
+        self.assertGreaterEqual(duplicates.similarity(listing, relisted),
+                                duplicates.SIMILARITY_THRESHOLD)
+        self.assertLess(duplicates.similarity(listing, other), duplicates.SIMILARITY_THRESHOLD)
+
+
+class FingerprintTest(unittest.TestCase):
+    def test_literals_collapse(self):
+        queries = ['SELECT "t1"."_id" FROM "realestate" AS t1 WHERE ("t1"."_id" = 12)',
+                   'SELECT "t1"."_id" FROM "realestate" AS t1\n WHERE ("t1"."_id" = 3.5)',
+                   'SELECT "t1"."_id" FROM "realestate" AS t1 WHERE ("t1"."_id" = ?)']
+        self.assertEqual(len({fingerprint(sql) for sql in queries}), 1)
+        self.assertEqual(fingerprint('SELECT * FROM "user" WHERE ("username" = \'it\'\'s\')'),
+                         fingerprint('SELECT * FROM "user" WHERE ("username" = ?)'))
+
+    def test_in_lists_collapse(self):
+        self.assertEqual(fingerprint('SELECT * FROM "realestate" WHERE ("_id" IN (?, ?, ?))'),
+                         fingerprint('SELECT * FROM "realestate" WHERE ("_id" IN (?))'))
+
+    def test_shapes_differ(self):
+        queries = ['SELECT "t1"."_id" FROM "realestate" AS t1 WHERE ("t1"."_id" = 12)',
+                   'SELECT "t1"."town" FROM "realestate" AS t1 WHERE ("t1"."_id" = 12)',
+                   'SELECT "t1"."_id" FROM "message" AS t1 WHERE ("t1"."_id" = 12)',
+                   'SELECT "t1"."_id" FROM "realestate" AS t1 WHERE ("t1"."sold" = 1)']
+        self.assertEqual(len({fingerprint(sql) for sql in queries}), len(queries))
+
+
+def _card_in_thread(_id):
+    """
+    The card of a property as another worker sees it: its own
+    connection only sees committed rows
+    """
+    cards = []
+
+    def run():
+        with app.test_request_context():
+            cards.extend(fragments.cards([_id]))
+        database.close()
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    return str(cards[0][1])
+
+
+class CardCacheTest(unittest.TestCase):
+    def test_card_of_committed_row(self):
+        with synthetic.environment():
+            synthetic.generate(properties=3, users=1)
+            realestate = Realestate.select().get()
+            self.assertNotIn("Testdorp", _card_in_thread(realestate._id))
+            with database.atomic():
+                realestate.town = "Testdorp"
+                realestate.save()
+                self.assertNotIn("Testdorp", _card_in_thread(realestate._id))
+            self.assertIn("Testdorp", _card_in_thread(realestate._id))
+
+
+class CompactTest(unittest.TestCase):
+    key = "realestate:test:feed"
+
+    def setUp(self):
+        self.environment = synthetic.environment()
+        self.environment.__enter__()
+
+    def tearDown(self):
+        self.environment.__exit__(None, None, None)
+
+    def _add(self, kind, day, hour):
+        ts = activity._day_start(day) + hour * 3600
+        r.zadd(self.key, json.dumps({'kind': kind, 'ts': ts, 'hour': hour}), ts)
+
+    def _entries(self):
+        return activity._entries(r.zrange(self.key, 0, -1))
+
+    def test_compact(self):
+        self._add('review', date(2016, 1, 4), 10)
+        self._add('review', date(2016, 1, 4), 12)
+        self._add('listing', date(2016, 1, 4), 14)
+        self._add('review', date(2016, 1, 5), 10)
+        self._add('message', date(2016, 1, 6), 9)
+        activity.compact(self.key, date(2016, 1, 6))
+        entries = self._entries()
+        self.assertEqual([(entry['kind'], entry.get('day'), entry.get('counts'))
+                          for entry in entries],
+                         [('summary', '2016-01-04', {'review': 2, 'listing': 1}),
+                          ('summary', '2016-01-05', {'review': 1}),
+                          ('message', None, None)])
+
+    def test_merge_with_earlier_summaries(self):
+        self._add('review', date(2016, 1, 4), 10)
+        activity.compact(self.key, date(2016, 1, 6))
+        self._add('review', date(2016, 1, 4), 12)
+        self._add('listing', date(2016, 1, 4), 14)
+        activity.compact(self.key, date(2016, 1, 6))
+        summaries = self._entries()
+        self.assertEqual(len(summaries), 1)
+        self.assertEqual(summaries[0]['counts'], {'review': 2, 'listing': 1})
+        activity.compact(self.key, date(2016, 1, 6))  # nothing left to compact
+        self.assertEqual(self._entries(), summaries)
+
+
+if __name__ == '__main__':
+    unittest.main()
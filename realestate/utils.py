@@ -1,5 +1,7 @@
 import re
-import requests
+import math
+import struct
+import hashlib
 from werkzeug.routing import BaseConverter
 
 
@@ -38,6 +40,7 @@ def extract_text_from_google_maps_api_request(request_json, required_info):
 
 
 def google_maps_request(origin, destination, required_info):
+    import requests  # slow to import, and only needed for the Google Maps criteria
     url = google_maps_url(origin, destination)
 
     try:
@@ -61,6 +64,19 @@ def distance(origin, destination):
     return google_maps_request(origin, destination, 'distance')
 
 
+def parse_address(address):
+    """
+    Split a Belgian address ("Kerkstraat 1, 3000 Leuven") into
+    (postcode, town). Without a postcode, the last word of the
+    address is taken to be the town.
+    """
+    match = re.search(r'(\d{4})\s+([^,\d]+)$', address.strip())
+    if match:
+        return match.group(1), match.group(2).strip()
+    words = address.split()
+    return None, words[-1] if words else None
+
+
 def to_snakecase(name):
     try:
         return name.replace(" ", "_").lower()
@@ -68,6 +84,41 @@ def to_snakecase(name):
         return None
 
 
+class BloomFilter:
+    """
+    A set that answers "probably yes" or "certainly not", in a fixed
+    number of bits. Bit positions are (h1 + i * h2) mod bits, where
+    h1 and h2 are the first two big-endian 64-bit words of the SHA-1
+    of the UTF-8 value, so clients can check membership themselves.
+    """
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data or (bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        hashes = max(int(round(bits / capacity * math.log(2))), 1)
+        return cls(bits, hashes)
+
+    def _positions(self, value):
+        h1, h2 = struct.unpack('>QQ', hashlib.sha1(value.encode()).digest()[:16])
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.data[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, value):
+        return all(self.data[position // 8] & (1 << (position % 8))
+                   for position in self._positions(value))
+
+    def to_bytes(self):
+        return bytes(self.data)
+
+
 def camel_to_snake(name):
     s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
@@ -0,0 +1,35 @@
+import sys
+from realestate.celery import celery
+from config import CELERY_WORKERS
+
+"""
+Entry point for the Celery workers. It only loads the models and the
+tasks, not the views, forms or templates. Run one worker per queue,
+so a long cache rebuild can't hold up the ingestion of new listings:
+
+    python -m realestate.worker ingestion
+
+Concurrency and prefetch come from CELERY_WORKERS in config.py. The
+cache worker also runs the periodic tasks (CELERYBEAT_SCHEDULE).
+Anything else can be passed on to the worker:
+
+    python -m realestate.worker cache --loglevel=info
+"""
+
+
+BEAT_QUEUE = 'cache'
+
+
+def start(queue, *options):
+    settings = CELERY_WORKERS[queue]
+    celery.conf.update(CELERYD_PREFETCH_MULTIPLIER=settings['prefetch'])
+    celery.worker_main(['worker',
+                        '--queues', queue,
+                        '--concurrency', str(settings['concurrency']),
+                        '--hostname', queue + '@%h'] +
+                       (['--beat'] if queue == BEAT_QUEUE else []) +
+                       list(options))
+
+
+if __name__ == '__main__':
+    start(*sys.argv[1:])
@@ -0,0 +1,9 @@
+from realestate import create_app
+
+"""
+The web app, for gunicorn:
+
+    gunicorn -c gunicorn_config.py wsgi:app
+"""
+
+app = create_app()